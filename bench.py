@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+from datetime import date, timedelta
+from decimal import Decimal
+from util import *
+from storage import LAYOUTS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+## ============================================================================
+# Query workloads of the benchmark, as query.py arguments. The values exist
+# in every generated feed
+## ----------------------------------------------------------------------------
+WORKLOADS = [
+    ('point_filter', ['-s', '*', '-f', 'STB=stb1']),
+    ('multi_filter', ['-s', 'STB,TITLE,REV', '-f',
+                      'STB=stb1 AND REV>10.00 AND DATE>=2014-06-01']),
+    ('order_by', ['-s', 'STB,DATE,REV', '-f', 'REV>=19.00', '-o', 'DATE:desc,REV']),
+    ('order_by_limit', ['-s', 'STB,TITLE,DATE', '-o', 'DATE,TITLE', '-l', '100']),
+    ('aggregate', ['-s', 'PROVIDER,REV:sum,VIEW_TIME:max,STB:count', '-g', 'PROVIDER']),
+    ('scan', ['-s', '*']),
+]
+PERCENTILES = [50, 90, 99]
+
+## ============================================================================
+# Queries of the engine check (--check), which runs them with the vectorized
+# engine and with --no_vectorize over every layout. The feed has negative
+# revenues, so the numeric parsers are checked with the sign
+## ----------------------------------------------------------------------------
+CHECK_QUERIES = [
+    ['-s', 'REV:min,REV:max,REV:sum,REV:count,VIEW_TIME:min,VIEW_TIME:max,'
+           'VIEW_TIME:sum,DATE:min,DATE:max,STB:count'],
+    ['-s', 'PROVIDER,REV:min,REV:max,REV:sum,DATE:count', '-g', 'PROVIDER'],
+    ['-s', 'PROVIDER,DATE,REV:sum,VIEW_TIME:max', '-g', 'PROVIDER,DATE'],
+    ['-s', 'STB,REV:min,REV:sum,DATE:max', '-g', 'STB', '-f', 'DATE>=2014-06-01'],
+    ['-s', 'REV:sum,REV:count,VIEW_TIME:min', '-f', 'REV<0.00'],
+]
+CHECK_ROWS = 20000
+TOTALS_QUERY = ['-s', 'REV:sum,REV:min,REV:max'] # Checked against the feed text
+EMPTY_QUERY = ['-s', 'REV:sum,REV:min,DATE:max,STB:count,TITLE:collect', '-f', 'STB=none']
+EMPTY_RESULT = 'REV:sum,REV:min,DATE:max,STB:count,TITLE:collect\n,,,0,[]\n'
+
+## ============================================================================
+def generate_feed(stream, num_rows, cardinality, seed=0, signed=False):
+    """ Writes a synthetic pipe separated feed matching the current schema
+
+        :param stream: Stream to write the feed to
+        :param num_rows: Number of rows to generate
+        :param cardinality: Number of distinct values for the Char columns
+        :param seed: Seed for the random generator
+        :param signed: Make a fifth of the revenues negative
+    """
+    rand = random.Random(seed)
+    first_day = date(2014, 1, 1)
+    stream.write('|'.join([c.name for c in SCHEMA.columns]) + '\n')
+    for _ in xrange(num_rows):
+        day = first_day + timedelta(days=rand.randint(0, 364))
+        minutes = rand.randint(0, 300)
+        sign = '-' if signed and rand.random() < 0.2 else ''
+        stream.write('stb%i|title %i|provider %i|%s|%s%i.%02i|%i:%02i\n' % (
+            rand.randint(1, cardinality), rand.randint(1, cardinality),
+            rand.randint(1, max(cardinality / 100, 1)), day.isoformat(), sign,
+            rand.randint(0, 20), rand.randint(0, 99), minutes / 60, minutes % 60))
+
+## ============================================================================
+def import_feed(feed, output, memory_budget=0):
+    """ Runs the import process over a generated feed
+
+        :param feed: Path of the feed to import
+        :param output: Name of the new datastore
+        :param memory_budget: Memory budget (MB) for the import indexes
+        :returns: The wall time of the import, in seconds, and its peak
+                  resident memory, in KB
+    """
+    return run_process([os.path.join(HERE, 'import.py'), feed, '-o', output,
+                        '--memory_budget', str(memory_budget)])[:2]
+
+## ============================================================================
+def run_process(arguments):
+    """ Runs a Python script of the tool
+
+        :param arguments: The script and its arguments
+        :returns: The wall time of the process, in seconds, its peak resident
+                  memory, in KB, and its output
+    """
+    start = time.time()
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.Popen([sys.executable] + arguments, stdout=output)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+        if status != 0:
+            error('Failed: %s' % ' '.join(arguments))
+        output.seek(0)
+        return elapsed, usage.ru_maxrss, output.read()
+
+## ============================================================================
+def percentile(values, percent):
+    """ :returns: The nearest rank percentile of a list of values
+    """
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+## ============================================================================
+def run_workload(output, arguments, num_rows, options):
+    """ Runs a query workload several times
+
+        :param output: Name of the datastore
+        :param arguments: The query.py arguments of the workload
+        :param num_rows: Number of rows in the datastore
+        :param options: Command line arguments
+        :returns: Dictionary with the latencies, in seconds, the rows per
+                  second (by the median latency), the result rows and the
+                  peak resident memory, in KB
+    """
+    latencies, peak_rss, result_rows = [], 0, 0
+    for _ in range(options.repeat):
+        elapsed, rss, result = run_process([os.path.join(HERE, 'query.py'), '-i', output]
+                                           + arguments + options.query_options.split())
+        latencies.append(elapsed)
+        peak_rss = max(peak_rss, rss)
+        result_rows = max(result.count('\n') - 1, 0) # Without the header
+    latency = {'min': min(latencies), 'max': max(latencies),
+               'mean': sum(latencies) / len(latencies)}
+    for percent in PERCENTILES:
+        latency['p%i' % percent] = percentile(latencies, percent)
+    return {'arguments': arguments, 'runs': options.repeat, 'latency': latency,
+            'rows_per_sec': num_rows / max(latency['p50'], 1e-9),
+            'result_rows': result_rows, 'peak_rss_kb': peak_rss}
+
+## ============================================================================
+def current_commit():
+    """ :returns: The git commit of the tool, None out of a git checkout
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+## ============================================================================
+def feed_totals(feed):
+    """ :returns: The expected output of TOTALS_QUERY, computed with decimals
+                  from the text of a feed
+    """
+    position = column_by_name('REV').index
+    with open(feed, 'r') as stream:
+        stream.readline()
+        revenues = [Decimal(line.split('|')[position]) for line in stream]
+    return 'REV:sum,REV:min,REV:max\n%s,%s,%s\n' % (sum(revenues), min(revenues),
+                                                    max(revenues))
+
+## ============================================================================
+def check_engines(options):
+    """ Runs the check queries with the vectorized and the object engines,
+        over a generated feed imported in every layout, and fails if any
+        output differs or the money totals differ from the feed
+
+        :param options: Command line arguments
+    """
+    workdir = tempfile.mkdtemp(prefix='query-check-')
+    mismatches = 0
+    try:
+        feed = os.path.join(workdir, 'feed.txt')
+        with open(feed, 'w') as stream:
+            generate_feed(stream, CHECK_ROWS, 100, options.seed, signed=True)
+        totals = feed_totals(feed)
+        for layout in LAYOUTS:
+            output = os.path.join(workdir, layout)
+            run_process([os.path.join(HERE, 'import.py'), feed, '-o', output,
+                         '--layout', layout])
+            for arguments in CHECK_QUERIES:
+                query = [os.path.join(HERE, 'query.py'), '-i', output] + arguments
+                if run_process(query)[2] != run_process(query + ['--no_vectorize'])[2]:
+                    print >> sys.stderr, 'Engines differ on %s: %s' % (layout,
+                                                                      ' '.join(arguments))
+                    mismatches += 1
+            query = [os.path.join(HERE, 'query.py'), '-i', output]
+            for engine in [[], ['--no_vectorize']]:
+                if run_process(query + TOTALS_QUERY + engine)[2] != totals:
+                    print >> sys.stderr, 'Wrong totals on %s %s: %s' % (
+                        layout, ' '.join(engine), ' '.join(TOTALS_QUERY))
+                    mismatches += 1
+                if run_process(query + EMPTY_QUERY + engine)[2] != EMPTY_RESULT:
+                    print >> sys.stderr, 'Wrong empty selection on %s %s: %s' % (
+                        layout, ' '.join(engine), ' '.join(EMPTY_QUERY))
+                    mismatches += 1
+    finally:
+        shutil.rmtree(workdir)
+    if mismatches:
+        error('%i queries differ between the engines or from the feed' % mismatches)
+    print >> sys.stderr, 'The engines agree on %i queries over %i layouts, with ' \
+        'the feed totals and on an empty selection' % (len(CHECK_QUERIES),
+                                                       len(LAYOUTS))
+
+## ============================================================================
+def run(options):
+    """ Runs the benchmark for every requested size and cardinality, and
+        prints the report as JSON
+
+        :param options: Command line arguments
+    """
+    report = {'commit': current_commit(), 'python': platform.python_version(),
+              'repeat': options.repeat, 'query_options': options.query_options,
+              'datasets': []}
+    workloads = [w for w in WORKLOADS
+                 if not options.workloads or w[0] in options.workloads.split(',')]
+    workdir = tempfile.mkdtemp(prefix='query-bench-')
+    try:
+        for num_rows in [int(n) for n in options.rows.split(',')]:
+            for cardinality in [int(c) for c in options.cardinality.split(',')]:
+                feed = os.path.join(workdir, 'feed.txt')
+                output = os.path.join(workdir, 'data-%i-%i' % (num_rows, cardinality))
+                with open(feed, 'w') as stream:
+                    generate_feed(stream, num_rows, cardinality, options.seed)
+                import_time, import_rss = import_feed(feed, output, options.memory_budget)
+                os.remove(feed)
+                dataset = {'rows': num_rows, 'cardinality': cardinality,
+                           'import': {'seconds': import_time,
+                                      'rows_per_sec': num_rows / max(import_time, 1e-9),
+                                      'peak_rss_kb': import_rss},
+                           'queries': {}}
+                for name, arguments in workloads:
+                    debug('running %s over %i rows', options.verbose, name, num_rows)
+                    dataset['queries'][name] = run_workload(output, arguments,
+                                                            num_rows, options)
+                report['datasets'].append(dataset)
+    finally:
+        shutil.rmtree(workdir)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print
+
+## ============================================================================
+if __name__ == '__main__':
+    """ Program entry point
+        Measures the import and a fixed set of query workloads over
+        generated feeds, and reports them as JSON to compare versions
+    """
+    parser = argparse.ArgumentParser(description='Query tool benchmark')
+    parser.add_argument('-r', '--rows', type=str, default='1000000,10000000',
+        metavar='SIZES', help='comma separated datastore sizes')
+    parser.add_argument('-c', '--cardinality', type=str, default='1000',
+        metavar='VALUES', help='comma separated distinct values for the Char columns')
+    parser.add_argument('-m', '--memory_budget', type=int, default=0, metavar='MB',
+        help='memory budget for the import indexes, 0 keeps them in memory')
+    parser.add_argument('-n', '--repeat', type=int, default=5, metavar='N',
+        help='runs of every query workload')
+    parser.add_argument('-w', '--workloads', type=str, default='', metavar='NAMES',
+        help='comma separated workloads to run, from: %s' %
+             ', '.join([name for name, _ in WORKLOADS]))
+    parser.add_argument('-q', '--query_options', type=str, default='',
+        metavar='OPTIONS', help='extra query.py options, like --mmap')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated feeds')
+    parser.add_argument('--check', action='store_true',
+        help='check that the vectorized and object engines give the same '
+             'aggregates on every layout, instead of the benchmark')
+    parser.add_argument('--verbose', action='store_true', help='show debug messages')
+    args = parser.parse_args()
+    if args.check:
+        check_engines(args)
+    else:
+        run(args)
@@ -1,9 +1,32 @@
 #!/usr/bin/env python
 
-from collections import OrderedDict
-import pickle
+from multiprocessing import Pool
+from array import array
+try:
+    import cPickle as pickle # The upsert keys are large
+except ImportError:
+    import pickle
+import shutil
+import glob
 import sys
+import os
 from util import *
+from util import ID
+from storage import LAYOUTS, COMPRESSORS, ColumnarWriter, BlockWriter, \
+    write_dictionaries, load_schema
+from index import Index, IndexBuilder, IndexMerger, index_file, rank_file, \
+    rows_file, read_rows, shadowed_rows, write_ranks, delta_entries, \
+    check_index_format
+from planner import column_stats
+from metrics import count as count_metric, timer, enable_metrics, output_metrics, \
+    start_profile, stop_profile
+
+## ============================================================================
+# Upserts look up the key of every record in a dictionary of the key to the
+# row id, saved in <output>.keys. The records are processed in batches, and
+# the rows of a batch are written in row order
+## ----------------------------------------------------------------------------
+UPSERT_BATCH = 10000
 
 ## ============================================================================
 def parse_line(c, line, datastore, options):
@@ -12,48 +35,159 @@ def parse_line(c, line, datastore, options):
         :param c: Line index
         :param line: Current line 
         :param datastore: Local datastore to save the line
-        :returns: Parsed fields from the line
+        :returns: Parsed fields from the line, the dictionary encoded columns
+                  hold the ids of their values
     """
     fields = line.strip().split('|')
-    if len(fields) != len(COLUMNS):
+    if len(fields) != len(SCHEMA.columns):
         error('Invalid line: %s' % line.strip())
-    debug('parsing line %i: %s' % (c, str(fields)), options.verbose)
-    indexes = datastore['indexes']
-    out_fields = []
-    for f, field in enumerate(fields):
-        column = column_by_position(f)
-        out_fields.append((field, column))
-        if column.is_index:
-            debug('indexing %s: %s' % (column.name, field), options.verbose)
-            key_index = indexes[column.name].get(field, [])
-            key_index.append(c)
-            indexes[column.name][field] = key_index
-    return out_fields
+    SCHEMA.encode(fields)
+    verbose = options.verbose
+    if verbose:
+        debug('parsing line %i: %s', verbose, c, fields)
+    for column, builder in datastore['builders']:
+        if verbose:
+            debug('indexing %s: %s', verbose, column.name, fields[column.index])
+        builder.add(fields[column.index], c)
+    return fields
 
 ## ============================================================================
 def save_datastore(datastore, options):
     """ Saves current datastore to the local filesystem, for further reading
-        in the query process.
+        in the query process. Each index is saved sorted by key in its own
+        file, the .ds file keeps the metadata, the indexed column names and
+        their statistics for the query planner.
 
         :param datastore: Datastore to save
         :param options: Options dictionary from command line args
     """
-    msg = 'saving datastore %s to file %s.ds' 
-    debug(msg % (str(datastore), options.output), options.verbose)
+    indexes = datastore['indexes']
+    for column_name, index in indexes.iteritems():
+        debug('saving index %s', options.verbose, column_name)
+        with timer('save indexes'):
+            index.save(index_file(options.output, column_name))
+        with timer('write ranks'):
+            write_ranks(index_file(options.output, column_name),
+                        rank_file(options.output, column_name), datastore['num_rows'])
+    with timer('gather stats'):
+        stats = gather_stats(indexes.iterkeys(), options)
+    metadata = dict(datastore, indexes=sorted(indexes.iterkeys()), stats=stats)
+    del metadata['builders']
+    write_dictionaries(options.output)
+    save_metadata(metadata, options)
+
+## ============================================================================
+def gather_stats(column_names, options):
+    """ :returns: A dictionary with the statistics of every indexed column,
+                  from the saved base indexes
+    """
+    stats = {}
+    for column_name in column_names:
+        index = Index(index_file(options.output, column_name))
+        stats[column_name] = column_stats(index)
+        index.close()
+    return stats
+
+## ============================================================================
+def save_metadata(metadata, options):
+    """ Writes the .ds file of the datastore
+
+        :param metadata: Datastore metadata, with the indexed column names
+        :param options: Options dictionary from command line args
+    """
+    debug('saving datastore %s to file %s.ds', options.verbose, metadata, options.output)
     ds_file = open('%s.ds' % options.output, 'wb')
-    pickle.dump(datastore, ds_file)
+    pickle.dump(metadata, ds_file)
     ds_file.close()
 
 ## ============================================================================
-def sort_indexes(datastore, options):
-    """ Sort the processed indexes by fields value
-        :param datastore: Current datastore 
+def load_metadata(options):
+    """ Reads the .ds file of an existing datastore
+
         :param options: Options dictionary from command line args
+        :returns: The datastore metadata
     """
-    indexes = datastore['indexes']
-    for column_name, index in indexes.iteritems():
-        debug('sorting index %s: %s' % (column_name, str(index)), options.verbose)
-        indexes[column_name] = OrderedDict(sorted(index.items(), key=lambda v: v[0]))
+    try:
+        with open('%s.ds' % options.output, 'rb') as ds_file:
+            metadata = pickle.load(ds_file)
+    except IOError as e:
+        error('Unable to load datastore: %s' % e)
+    check_index_format(metadata, options.output)
+    schema = metadata.setdefault('schema', DEFAULT_DEFINITIONS)
+    if options.schema and read_schema(options.schema) != schema:
+        error('The schema does not match the datastore %s' % options.output)
+    load_schema(dict(metadata, datafile=options.output))
+    metadata['encoded'] = sorted(SCHEMA.dictionaries)
+    return metadata
+
+## ============================================================================
+def new_schema(definitions, options):
+    """ Loads the schema of a new datastore, with an empty dictionary for
+        every Char column unless --no_dictionary is given. The columnar
+        layout always encodes its Char columns
+
+        :param definitions: List of (name, type, size, is indexed) tuples
+        :param options: Options dictionary from command line args
+    """
+    encoded = options.layout == 'columnar' or not options.no_dictionary
+    SCHEMA.load(definitions, {name: [] for name, type_name, _, _ in definitions
+                              if encoded and type_name == 'char'})
+
+## ============================================================================
+def new_datastore(output, options):
+    """ :returns: An empty datastore of the current schema, with an index
+                  builder per indexed column
+    """
+    indexes = {c.name: IndexBuilder(c, SCHEMA.dictionaries.get(c.name))
+               for c in SCHEMA.columns if c.is_index}
+    return {'datafile': output, 'layout': options.layout,
+            'schema': SCHEMA.definitions, 'encoded': sorted(SCHEMA.dictionaries),
+            'indexes': indexes,
+            'builders': [(c, indexes[c.name]) for c in SCHEMA.columns if c.is_index]}
+
+## ============================================================================
+def import_lines(lines, first_row, datastore, write, options):
+    """ Parses, writes and indexes a sequence of lines
+
+        :param lines: The lines to import
+        :param first_row: Row id of the first line
+        :param datastore: Datastore holding the index builders
+        :param write: Function to write the parsed fields of a line
+        :param options: Options dictionary from command line args
+        :returns: The number of imported lines
+    """
+    builders = datastore['indexes'].values()
+    budget = options.memory_budget * 1024 * 1024
+    num_rows, num_spills = 0, 0
+    with timer('parse and write'):
+        for c, line in enumerate(lines, first_row):
+            fields = parse_line(c, line, datastore, options)
+            write(fields)
+            num_rows += 1
+            if budget and sum([b.size for b in builders]) > budget:
+                debug('spilling indexes at line %i', options.verbose, c)
+                num_spills += 1
+                for builder in builders:
+                    builder.spill()
+    count_metric('rows imported', num_rows)
+    count_metric('index spills', num_spills)
+    return num_rows
+
+## ============================================================================
+def remove_files(pattern):
+    """ Removes the files left by a previous datastore or delta with the same
+        name, so they are not taken for files of the new one
+    """
+    for path in glob.glob(pattern):
+        os.remove(path)
+
+## ============================================================================
+def remove_deltas(output):
+    """ Removes the delta and upsert key files of a datastore, before it is
+        imported again
+    """
+    remove_files('%s.delta*' % output)
+    remove_files(keys_file(output))
 
 ## ============================================================================
 def import_stream(stream, options):
@@ -62,38 +196,361 @@ def import_stream(stream, options):
         :param stream: The stream to import, data separated by pipes
         :param options: Options dictionary from command line args
     """
-    data_file = open(options.output, 'w')
-    datastore = {'datafile': options.output, 
-                 'indexes': {c.name: {} for c in COLUMNS if c.is_index}}
-    for c, line in enumerate(stream):
-        fields = parse_line(c, line, datastore, options)
-        data_file.write(format_output_fields(fields, options))
-    # -------------------------------------------------------------------------  
-    datastore['num_rows'] = c+1
-    sort_indexes(datastore, options)
+    if options.layout == 'columnar':
+        data_file = ColumnarWriter(options.output, SCHEMA.columns)
+        write = data_file.write_fields
+    elif options.layout == 'block':
+        data_file = BlockWriter(options.output, options.compression)
+        write = lambda fields: data_file.write_row(SCHEMA.format_row(fields), fields)
+    else:
+        data_file = open(options.output, 'w')
+        write = lambda fields: data_file.write(SCHEMA.format_row(fields))
+    remove_deltas(options.output)
+    datastore = new_datastore(options.output, options)
+    datastore['num_rows'] = import_lines(stream, 0, datastore, write, options)
     save_datastore(datastore, options)
     data_file.close()
 
 ## ============================================================================
-def format_output_field(field, options):
-    """ Format a field to save in the datastore
+def append_stream(stream, options):
+    """ Appends a pipe separated stream to an existing datastore. The rows
+        are written after the last row of the data file, and indexed in a
+        delta index that queries merge with the base index until the
+        datastore is compacted
+
+        :param stream: The stream to import, data separated by pipes
+        :param options: Options dictionary from command line args
+    """
+    metadata = load_metadata(options)
+    if metadata.get('layout', 'row') != 'row':
+        error('Appending is only supported for the row layout')
+    first_row, deltas = metadata['num_rows'], metadata.get('deltas', [])
+    delta = '%s.delta%i' % (options.output, len(deltas) + 1)
+    data_file = open(options.output, 'r+')
+    data_file.seek(first_row * SCHEMA.row_size)
+    data_file.truncate() # Drop any partial row of an interrupted import
+    write = lambda fields: data_file.write(SCHEMA.format_row(fields))
+    remove_files('%s.*' % delta)
+    datastore = new_datastore(delta, options)
+    num_rows = import_lines(stream, first_row, datastore, write, options)
+    data_file.close()
+    if num_rows == 0:
+        return
+    for column_name, builder in datastore['indexes'].iteritems():
+        debug('saving delta index %s', options.verbose, column_name)
+        builder.save(index_file(delta, column_name))
+        write_ranks(index_file(delta, column_name), rank_file(delta, column_name),
+                    num_rows, first_row)
+    metadata['num_rows'] = first_row + num_rows
+    metadata['deltas'] = deltas + [(delta, first_row, False)]
+    write_dictionaries(options.output)
+    save_metadata(metadata, options)
+    if len(metadata['deltas']) >= options.max_deltas:
+        compact_datastore(options)
+
+## ============================================================================
+def keys_file(output):
+    """ :returns: The file holding the upsert keys of a datastore """
+    return '%s.keys' % output
+
+## ============================================================================
+def load_keys(metadata, key_columns, options):
+    """ Loads the dictionary of the upsert keys, and adds the rows imported
+        since it was saved (or every row, if it was saved for other columns)
 
-        :param fieldf: A field to format
+        :param metadata: The datastore metadata
+        :param key_columns: The columns of the key
         :param options: Options dictionary from command line args
-        :returns: A string in the the datastore format, based on the
-                  field length
+        :returns: A dictionary with the row id of every key
     """
-    return ('{:<%i}' % field[1].size).format(field[0])
+    keys, first_row = {}, 0
+    if metadata.get('key_columns') == [c.name for c in key_columns]:
+        with open(keys_file(options.output), 'rb') as keys_data:
+            keys = pickle.load(keys_data)
+        first_row = metadata['keys_rows']
+    debug('adding rows %i to %i to the upsert keys', options.verbose,
+          first_row, metadata['num_rows'])
+    split = SCHEMA.codec(key_columns).split
+    with open(options.output, 'r') as data_file:
+        data_file.seek(first_row * SCHEMA.row_size)
+        for row in xrange(first_row, metadata['num_rows']):
+            keys[tuple(split(data_file.read(SCHEMA.row_size)))] = row
+    return keys
 
 ## ============================================================================
-def format_output_fields(fields, options):
-    """ Format a list of fields to save in the datastore
+def upsert_batch(lines, keys, key_columns, next_row, data_file, options):
+    """ Writes a batch of records, over the row of their key when it is
+        already in the datastore, or after the last row otherwise. The last
+        record of a key in the batch wins
 
-        :param fields: List of fields to format
+        :param lines: The lines of the batch
+        :param keys: Dictionary with the row id of every key, updated with the
+                     new keys
+        :param key_columns: The columns of the key
+        :param next_row: Row id of the next appended row
+        :param data_file: The data file, open for update
         :param options: Options dictionary from command line args
-        :returns: A string in the the datastore format
+        :returns: The written row ids and the next appended row id
     """
-    return ''.join([format_output_field(f, options) for f in fields])
+    rows = {}
+    encoded = [c.name in SCHEMA.dictionaries for c in key_columns]
+    for line in lines:
+        fields = line.strip().split('|')
+        if len(fields) != len(SCHEMA.columns):
+            error('Invalid line: %s' % line.strip())
+        SCHEMA.encode(fields)
+        key = tuple([fields[c.index] if is_id else fields[c.index].strip()
+                     for c, is_id in zip(key_columns, encoded)])
+        row = keys.get(key)
+        if row is None:
+            row = keys[key] = next_row
+            next_row += 1
+        rows[row] = SCHEMA.format_row(fields)
+    for row in sorted(rows):
+        data_file.seek(row * SCHEMA.row_size)
+        data_file.write(rows[row])
+    return rows.keys(), next_row
+
+## ============================================================================
+def upsert_stream(stream, options):
+    """ Imports a pipe separated stream, replacing the rows with the same
+        key. The rows are overwritten in place or appended, and the written
+        rows are indexed in a delta index. Queries leave out the postings of
+        the rewritten rows in the older indexes
+
+        :param stream: The stream to import, data separated by pipes
+        :param options: Options dictionary from command line args
+    """
+    if not os.path.exists('%s.ds' % options.output):
+        import_stream(iter([]), options)
+    metadata = load_metadata(options)
+    if metadata.get('layout', 'row') != 'row':
+        error('Upserting is only supported for the row layout')
+    key_columns = [column_by_name(name, True) for name in options.key.split(',')]
+    keys = load_keys(metadata, key_columns, options)
+    first_row, deltas = metadata['num_rows'], metadata.get('deltas', [])
+    delta = '%s.delta%i' % (options.output, len(deltas) + 1)
+    next_row = first_row
+    written = set()
+    data_file = open(options.output, 'r+')
+    data_file.seek(first_row * SCHEMA.row_size)
+    data_file.truncate() # Drop any partial row of an interrupted import
+    batch = []
+    for line in stream:
+        batch.append(line)
+        if len(batch) == UPSERT_BATCH:
+            rows, next_row = upsert_batch(batch, keys, key_columns, next_row,
+                                          data_file, options)
+            written.update(rows)
+            batch = []
+    rows, next_row = upsert_batch(batch, keys, key_columns, next_row,
+                                  data_file, options)
+    written.update(rows)
+    data_file.close()
+    debug('%i rows rewritten, %i appended', options.verbose,
+          len(written) - (next_row - first_row), next_row - first_row)
+    if written:
+        # Index the final value of every written row, read back from the
+        # data file, as a row may be written by several batches
+        row_ids = array('I', sorted(written))
+        remove_files('%s.*' % delta)
+        datastore = new_datastore(delta, options)
+        builders = [builder for _, builder in datastore['builders']]
+        split = SCHEMA.codec([column for column, _ in datastore['builders']]).split
+        with open(options.output, 'r') as data_file:
+            for row in row_ids:
+                data_file.seek(row * SCHEMA.row_size)
+                for builder, field in zip(builders, split(data_file.read(SCHEMA.row_size))):
+                    builder.add(field, row)
+        with open(rows_file(delta), 'wb') as rows_data:
+            row_ids.tofile(rows_data)
+        for column_name, builder in datastore['indexes'].iteritems():
+            debug('saving delta index %s', options.verbose, column_name)
+            builder.save(index_file(delta, column_name))
+            write_ranks(index_file(delta, column_name), rank_file(delta, column_name),
+                        len(row_ids), row_ids=row_ids)
+        metadata['deltas'] = deltas + [(delta, first_row, True)]
+    with open(keys_file(options.output), 'wb') as keys_data:
+        pickle.dump(keys, keys_data, pickle.HIGHEST_PROTOCOL)
+    metadata['num_rows'] = next_row
+    metadata['key_columns'] = [c.name for c in key_columns]
+    metadata['keys_rows'] = next_row
+    write_dictionaries(options.output)
+    save_metadata(metadata, options)
+    if len(metadata.get('deltas', [])) >= options.max_deltas:
+        compact_datastore(options)
+
+## ============================================================================
+def compact_datastore(options):
+    """ Merges the delta indexes of a datastore into its base indexes
+
+        :param options: Options dictionary from command line args
+    """
+    metadata = load_metadata(options)
+    deltas = delta_entries(metadata.get('deltas', []))
+    if not deltas:
+        return
+    debug('compacting %i delta indexes', options.verbose, len(deltas))
+    prefixes = [options.output] + [delta for delta, _, _ in deltas]
+    parts = [(0, None)]
+    for delta, first_row, upserted in deltas:
+        parts.append((first_row, read_rows(rows_file(delta)) if upserted else None))
+    shadows = shadowed_rows(parts)
+    for column_name in metadata['indexes']:
+        path = index_file(options.output, column_name)
+        ranks = rank_file(options.output, column_name)
+        IndexMerger([index_file(p, column_name) for p in prefixes],
+                    shadows).save(path + '.tmp')
+        write_ranks(path + '.tmp', ranks + '.tmp', metadata['num_rows'])
+        os.rename(path + '.tmp', path)
+        os.rename(ranks + '.tmp', ranks)
+    metadata['deltas'] = []
+    metadata['stats'] = gather_stats(metadata['indexes'], options)
+    save_metadata(metadata, options)
+    for delta in prefixes[1:]:
+        for column_name in metadata['indexes']:
+            os.remove(index_file(delta, column_name))
+            os.remove(rank_file(delta, column_name))
+        if os.path.exists(rows_file(delta)):
+            os.remove(rows_file(delta))
+
+## ============================================================================
+def split_file(path, begin, parts):
+    """ Splits a file in byte ranges that start on a line boundary
+
+        :param path: The file to split
+        :param begin: Position of the first line to import
+        :param parts: Number of ranges
+        :returns: A list of (begin, end) tuples
+    """
+    end = os.path.getsize(path)
+    bounds = [begin]
+    with open(path, 'rb') as stream:
+        for part in range(1, parts):
+            target = begin + (end - begin) * part / parts
+            if target <= bounds[-1]:
+                continue
+            stream.seek(target - 1)
+            stream.readline() # Move to the start of the next line
+            if stream.tell() < end:
+                bounds.append(stream.tell())
+    bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+## ============================================================================
+def count_lines(task):
+    """ Counts the lines of a byte range, the last line may not end in a
+        new line character
+
+        :param task: Tuple with the file name, the begin and end position
+        :returns: The number of lines in the range
+    """
+    path, begin, end = task
+    num_lines, last = 0, '\n'
+    with open(path, 'rb') as stream:
+        stream.seek(begin)
+        while begin < end:
+            block = stream.read(min(1 << 20, end - begin))
+            num_lines += block.count('\n')
+            begin += len(block)
+            last = block[-1]
+    return num_lines + (1 if last != '\n' else 0)
+
+## ============================================================================
+def read_lines(stream, begin, end):
+    """ :returns: A generator of the lines of a file between two positions
+    """
+    stream.seek(begin)
+    while begin < end:
+        line = stream.readline()
+        begin += len(line)
+        yield line
+
+## ============================================================================
+def import_part(task):
+    """ Imports a byte range of the input file to a partial datastore: the
+        fixed width rows in <output>.part<N> and the indexes of the part
+
+        :param task: Tuple with the part number, the byte range, the row id
+                     of its first line and the options
+        :returns: The name of the partial datastore and the values of its
+                  dictionaries
+    """
+    number, begin, end, first_row, options = task
+    output = '%s.part%i' % (options.output, number)
+    datastore = new_datastore(output, options)
+    data_file = open(output, 'w')
+    write = lambda fields: data_file.write(SCHEMA.format_row(fields))
+    with open(options.file, 'r') as stream:
+        import_lines(read_lines(stream, begin, end), first_row, datastore,
+                     write, options)
+    data_file.close()
+    for column_name, builder in datastore['indexes'].iteritems():
+        builder.save(index_file(output, column_name))
+    return output, {name: d.values for name, d in SCHEMA.dictionaries.iteritems()}
+
+## ============================================================================
+def copy_part(part, dictionaries, data_file):
+    """ Appends the rows of a partial datastore to the data file. The ids of
+        the part dictionaries are added to the dictionaries of the schema,
+        and the rows are rewritten with the new ids when they change
+
+        :param part: Name of the partial datastore
+        :param dictionaries: The values of the part dictionaries
+        :param data_file: The data file of the datastore
+    """
+    remaps = []
+    for column, _, dictionary in SCHEMA.encoded:
+        ids = [dictionary.id(value) for value in dictionaries[column.name]]
+        if ids != range(len(ids)):
+            remaps.append((column.offset, ids))
+    with open(part, 'rb') as part_file:
+        if not remaps:
+            return shutil.copyfileobj(part_file, data_file)
+        row_size = SCHEMA.row_size
+        while True:
+            block = bytearray(part_file.read(4096 * row_size))
+            if not block:
+                break
+            for row in xrange(0, len(block), row_size):
+                for offset, ids in remaps:
+                    position = row + offset
+                    ID.pack_into(block, position, ids[ID.unpack_from(block, position)[0]])
+            data_file.write(block)
+
+## ============================================================================
+def import_parallel(begin, options):
+    """ Imports the input file with a pool of processes. The file is split in
+        byte ranges, each one is imported as a partial datastore and then the
+        data files are concatenated and the indexes merged, in order
+
+        :param begin: Position of the first line to import
+        :param options: Options dictionary from command line args
+    """
+    if options.layout != 'row':
+        error('Parallel import is only supported for the row layout')
+    remove_deltas(options.output)
+    ranges = split_file(options.file, begin, options.workers)
+    pool = Pool(options.workers)
+    counts = pool.map(count_lines, [(options.file, b, e) for b, e in ranges])
+    first_rows = [sum(counts[:n]) for n in range(len(counts))]
+    tasks = [(n, b, e, first_rows[n], options) for n, (b, e) in enumerate(ranges)]
+    parts = pool.map(import_part, tasks)
+    pool.close()
+    pool.join()
+    with open(options.output, 'wb') as data_file:
+        for part, dictionaries in parts:
+            copy_part(part, dictionaries, data_file)
+    parts = [part for part, _ in parts]
+    datastore = new_datastore(options.output, options)
+    datastore['indexes'] = {name: IndexMerger([index_file(p, name) for p in parts])
+                            for name in datastore['indexes']}
+    datastore['num_rows'] = sum(counts)
+    save_datastore(datastore, options)
+    for part in parts:
+        os.remove(part)
+        for column_name in datastore['indexes']:
+            os.remove(index_file(part, column_name))
 
 ## ============================================================================
 if __name__ == '__main__':
@@ -102,14 +559,69 @@ if __name__ == '__main__':
     """
     import argparse
     parser = argparse.ArgumentParser(description='Import file or stream to local datastore')
-    parser.add_argument('file', type=str, default='-', help='File to import')
+    parser.add_argument('file', type=str, nargs='?', help='File to import, - for the standard input')
     parser.add_argument('-o', '--output', type=str, default='data', 
         metavar='OUTPUT', help='Name of the new datastore')
     parser.add_argument('--verbose', action='store_true', help='show debug messages')
     parser.add_argument('--no_header', action='store_true', default=False, help='process from line 1')
+    parser.add_argument('--layout', choices=LAYOUTS, default='row',
+        help='row: fixed width records, columnar: one binary file per column, '
+             'block: compressed blocks of fixed width records')
+    parser.add_argument('--compression', choices=sorted(COMPRESSORS), default='zlib',
+        help='compression of the block layout')
+    parser.add_argument('--memory_budget', type=int, default=0, metavar='MB',
+        help='spill the indexes to sorted runs on disk above this size')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+        help='import the file with N processes')
+    parser.add_argument('--append', action='store_true',
+        help='append the rows to an existing datastore')
+    parser.add_argument('--compact', action='store_true',
+        help='merge the indexes of the appended rows into the base indexes')
+    parser.add_argument('--max_deltas', type=int, default=8, metavar='N',
+        help='compact the datastore when N appends are pending')
+    parser.add_argument('--upsert', action='store_true',
+        help='replace the rows with the same key, append the new keys')
+    parser.add_argument('--schema', type=str, metavar='FILE',
+        help='definition file of the columns of a new datastore, one NAME TYPE '
+             'SIZE [noindex] line per column')
+    parser.add_argument('--no_dictionary', action='store_true',
+        help='store the char columns of a new row or block datastore as text, '
+             'not as ids in a dictionary of their values')
+    parser.add_argument('--key', type=str, default='STB,TITLE,DATE',
+        metavar='COLUMNS', help='comma separated key columns for --upsert')
+    parser.add_argument('--stats', action='store_true',
+        help='show counters and timers of the import in the error output')
+    parser.add_argument('--profile', type=str, metavar='FILE',
+        help='write a cProfile dump of the import to FILE')
     args = parser.parse_args()
-    debug('reading %s' % args.file, args.verbose)
-    stream = open(args.file, 'r') if args.file != '-' else sys.stdin
-    if not args.no_header: stream.readline()
-    import_stream(stream, args)
-    if args.file != '-': stream.close()
+    if args.file is None and not args.compact:
+        parser.error('a file to import is required')
+    new_schema(read_schema(args.schema) if args.schema else DEFAULT_DEFINITIONS, args)
+    if args.stats:
+        enable_metrics()
+    profiler = start_profile(args.profile)
+    try:
+        if args.file is not None:
+            debug('reading %s', args.verbose, args.file)
+            stream = open(args.file, 'r') if args.file != '-' else sys.stdin
+            if not args.no_header: stream.readline()
+            if args.append or args.upsert:
+                if args.workers > 1:
+                    error('Appending does not support parallel import')
+                if args.upsert:
+                    upsert_stream(stream, args)
+                else:
+                    append_stream(stream, args)
+            elif args.workers > 1:
+                if args.file == '-':
+                    error('Parallel import needs a file, not the standard input')
+                import_parallel(stream.tell(), args)
+            else:
+                import_stream(stream, args)
+            if args.file != '-': stream.close()
+        if args.compact:
+            with timer('compact'):
+                compact_datastore(args)
+    finally:
+        stop_profile(profiler, args.profile)
+    output_metrics()
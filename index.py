@@ -0,0 +1,616 @@
+__all__ = ['Index', 'Indexes', 'IndexBuilder', 'IndexMerger', 'IndexWriter',
+           'MergedIndex', 'write_index', 'write_ranks', 'index_file',
+           'rank_file', 'rows_file', 'read_rows', 'shadowed_rows', 'delta_entries',
+           'check_index_format']
+
+from array import array
+from bisect import bisect_left, bisect_right
+import heapq
+from itertools import groupby
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import threading
+from util import error
+from metrics import count as count_metric
+
+## ============================================================================
+# Layout of an index file:
+#   header: size of the keys block (unsigned int)
+#   keys: pickled list with the distinct keys, encoded with the column type
+#         (see util.Value.encode) and sorted
+#   offsets: array('I') with num_keys + 1 positions in the postings
+#   postings: array('I') with the row ids of every key, one run per key
+## ----------------------------------------------------------------------------
+HEADER = struct.Struct('<I')
+ITEM_SIZE = array('I').itemsize
+# The rank file of an index holds, for every row id, the position of the
+# key of the row in the index. Used to sort rows by several columns
+RANK = struct.Struct('I')
+
+## ============================================================================
+def index_file(prefix, column_name):
+    """ :returns: The file holding the index of a column """
+    return '%s.%s.idx' % (prefix, column_name)
+
+## ============================================================================
+def rank_file(prefix, column_name):
+    """ :returns: The file holding the row ranks of a column """
+    return '%s.%s.rank' % (prefix, column_name)
+
+## ============================================================================
+def rows_file(prefix):
+    """ :returns: The file holding the sorted row ids of an upsert delta """
+    return '%s.rows' % prefix
+
+## ============================================================================
+def check_index_format(metadata, name):
+    """ Exits if the .ds file was written by the first importer, which kept
+        the indexes in it as dictionaries instead of in their own files
+
+        :param metadata: The contents of the .ds file
+        :param name: Name of the datastore
+    """
+    if isinstance(metadata.get('indexes'), dict):
+        error('The datastore %s has the indexes of an old version, import it '
+              'again' % name)
+
+## ============================================================================
+def delta_entries(deltas):
+    """ :param deltas: The deltas of the .ds file
+        :returns: A list of (prefix, first row, upserted) of the deltas. The
+                  .ds files written before the kind of the delta was kept
+                  hold (prefix, first row), an upsert delta has a rows file
+    """
+    return [tuple(delta) if len(delta) == 3 else
+            (delta[0], delta[1], os.path.exists(rows_file(delta[0])))
+            for delta in deltas]
+
+## ============================================================================
+def read_rows(path):
+    """ :returns: An array with the row ids of a rows file
+    """
+    row_ids = array('I')
+    with open(path, 'rb') as rows_data:
+        row_ids.fromstring(rows_data.read())
+    return row_ids
+
+## ============================================================================
+def shadowed_rows(parts):
+    """ Finds the rows of every part that a later part rewrote. An upsert
+        overwrites rows in place and indexes them again in its delta, so the
+        postings of those rows in the older parts are stale
+
+        :param parts: List of (first row, row ids or None) tuples of the base
+                      index and the deltas, in order. The row ids of a delta
+                      are None when it only holds appended rows
+        :returns: A list with the set of stale rows of every part
+    """
+    shadows, later = [], set()
+    for first_row, row_ids in reversed(parts):
+        shadows.insert(0, set(later))
+        if row_ids is not None:
+            later.update(row_ids[:bisect_left(row_ids, first_row)])
+    return shadows
+
+## ============================================================================
+class IndexWriter():
+    """ Writes an index file from postings given in key order, so the whole
+        index never needs to be in memory. The postings are written to a
+        temporary file and copied after the keys when the writer is closed
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, path):
+        """ :param path: The file to write
+        """
+        self.path = path
+        self.keys = []
+        self.offsets = array('I')
+        self.num_postings = 0
+        self.postings = tempfile.TemporaryFile()
+
+    # -------------------------------------------------------------------------
+    def add(self, key, row_ids):
+        """ Adds the postings of a key, keys must be added in order. A key
+            can be added several times to append more row ids
+
+            :param key: The key of the postings
+            :param row_ids: Array with the row ids of the key
+        """
+        if not self.keys or self.keys[-1] != key:
+            self.keys.append(key)
+            self.offsets.append(self.num_postings)
+        row_ids.tofile(self.postings)
+        self.num_postings += len(row_ids)
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Writes the index file
+        """
+        self.offsets.append(self.num_postings)
+        keys_block = pickle.dumps(self.keys, pickle.HIGHEST_PROTOCOL)
+        self.postings.seek(0)
+        with open(self.path, 'wb') as idx_file:
+            idx_file.write(HEADER.pack(len(keys_block)))
+            idx_file.write(keys_block)
+            self.offsets.tofile(idx_file)
+            shutil.copyfileobj(self.postings, idx_file)
+        self.postings.close()
+
+## ============================================================================
+def encode_keys(index, column, dictionary=None):
+    """ Encodes the raw keys of an index with the column type, so the keys
+        sort by value and not as strings. Raw keys with the same value
+        (like 1:05 and 1:5) are merged. The ids of a dictionary encoded
+        column are replaced by their value, the saved keys sort by value
+
+        :param index: Dictionary with the row ids array of each raw key
+        :param column: The indexed column
+        :param dictionary: Dictionary of the column when the keys are ids
+        :returns: A list of (key, row ids) tuples, sorted by key
+    """
+    encoded = {}
+    for key, row_ids in index.iteritems():
+        if dictionary is not None:
+            key = dictionary.values[key]
+        try:
+            key = column.type(key).encode()
+        except ValueError:
+            error('Invalid value for column %s: %s' % (column.name, key))
+        if key in encoded:
+            row_ids = array('I', sorted(encoded[key] + row_ids))
+        encoded[key] = row_ids
+    return sorted(encoded.iteritems())
+
+## ============================================================================
+def write_index(path, index, column, dictionary=None):
+    """ Saves an index held in memory
+
+        :param path: The file to write
+        :param index: Dictionary with the row ids array of each raw key
+        :param column: The indexed column
+        :param dictionary: Dictionary of the column when the keys are ids
+    """
+    writer = IndexWriter(path)
+    for key, row_ids in encode_keys(index, column, dictionary):
+        writer.add(key, row_ids)
+    writer.close()
+
+## ============================================================================
+def write_ranks(index_path, path, num_rows, first_row=0, row_ids=None):
+    """ Writes the rank file of an index, the file is written through a
+        memory map, so the ranks are not held in memory
+
+        :param index_path: The index file
+        :param path: The rank file to write
+        :param num_rows: Number of rows in the index
+        :param first_row: Row id of the first row in the index
+        :param row_ids: Sorted row ids of an index that does not hold a
+                        contiguous range of rows, the ranks follow their order
+    """
+    slots = None
+    if row_ids is not None:
+        slots = {row: slot for slot, row in enumerate(row_ids)}
+    with open(path, 'w+b') as rank_data:
+        rank_data.truncate(num_rows * RANK.size)
+        if num_rows == 0:
+            return
+        ranks = mmap.mmap(rank_data.fileno(), 0)
+        index = Index(index_path)
+        for position, postings in enumerate(index.itervalues()):
+            for row in postings:
+                slot = row - first_row if slots is None else slots[row]
+                RANK.pack_into(ranks, slot * RANK.size, position)
+        index.close()
+        ranks.close()
+
+## ============================================================================
+class IndexBuilder():
+    """ Collects the postings of a column in the import process. When the
+        import runs with a memory budget the postings are spilled to disk in
+        sorted runs, which are merged when the index is saved
+    """
+    # Rough memory used by a new key: the string, the array and the dict slot
+    KEY_OVERHEAD = 200
+
+    # -------------------------------------------------------------------------
+    def __init__(self, column, dictionary=None):
+        """ :param column: The indexed column
+            :param dictionary: Dictionary of the column, when the keys added
+                               are the ids of a dictionary encoded column
+        """
+        self.column = column
+        self.dictionary = dictionary
+        self.index = {}
+        self.runs = []
+        self.size = 0
+
+    # -------------------------------------------------------------------------
+    def add(self, key, row_id):
+        """ Adds a row id to the postings of a key
+
+            :param key: The value of the column
+            :param row_id: The row holding the value
+        """
+        postings = self.index.get(key)
+        if postings is None:
+            postings = self.index[key] = array('I')
+            self.size += self.KEY_OVERHEAD
+        postings.append(row_id)
+        self.size += ITEM_SIZE
+
+    # -------------------------------------------------------------------------
+    def spill(self):
+        """ Writes the postings in memory to a temporary file as a run of
+            (key, row ids) records sorted by key. Each record is the pickled
+            key and count followed by the raw row ids array
+        """
+        if not self.index:
+            return
+        run = tempfile.TemporaryFile()
+        for key, row_ids in encode_keys(self.index, self.column, self.dictionary):
+            pickle.dump((key, len(row_ids)), run, pickle.HIGHEST_PROTOCOL)
+            row_ids.tofile(run)
+        run.seek(0)
+        count_metric('index runs')
+        self.runs.append(run)
+        self.index = {}
+        self.size = 0
+
+    # -------------------------------------------------------------------------
+    def save(self, path):
+        """ Writes the index file, merging the spilled runs if there are any.
+            Runs hold increasing row ids, so for equal keys the run number
+            keeps the postings in row order
+
+            :param path: The file to write
+        """
+        if not self.runs:
+            return write_index(path, self.index, self.column, self.dictionary)
+        self.spill()
+        merge_runs(path, [read_run(run, n) for n, run in enumerate(self.runs)])
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+## ============================================================================
+class IndexMerger():
+    """ Merges the index files of consecutive row ranges, as written by the
+        parallel import, or a base index and its deltas, into a single index
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, paths, shadows=None):
+        """ :param paths: The index files to merge, in row order
+            :param shadows: The set of stale rows of every index file, see
+                            shadowed_rows. None when no row was rewritten
+        """
+        self.paths = paths
+        self.shadows = shadows
+
+    # -------------------------------------------------------------------------
+    def save(self, path):
+        """ Writes the merged index file
+
+            :param path: The file to write
+        """
+        indexes = [Index(p) for p in self.paths]
+        merge_runs(path, [numbered(index.iteritems(), n)
+                          for n, index in enumerate(indexes)], self.shadows)
+        for index in indexes:
+            index.close()
+
+## ============================================================================
+def merge_runs(path, runs, shadows=None):
+    """ Writes an index file from runs sorted by key
+
+        :param path: The file to write
+        :param runs: Generators of (key, run number, row ids) tuples
+        :param shadows: The set of stale rows of every run, which are left
+                        out of the postings. None when no row was rewritten
+    """
+    writer = IndexWriter(path)
+    if not shadows or not any(shadows):
+        for key, _, row_ids in heapq.merge(*runs):
+            writer.add(key, row_ids)
+        writer.close()
+        return
+    # A rewritten row can be older than the rows of the key in the previous
+    # runs, so the postings of every key are merged and sorted
+    for key, items in groupby(heapq.merge(*runs), lambda item: item[0]):
+        row_ids = []
+        for _, number, run_rows in items:
+            row_ids.extend([r for r in run_rows if r not in shadows[number]])
+        if row_ids:
+            writer.add(key, array('I', sorted(row_ids)))
+    writer.close()
+
+## ============================================================================
+def numbered(items, number):
+    """ :returns: A generator of (key, number, row ids) from (key, row ids)
+    """
+    for key, row_ids in items:
+        yield key, number, row_ids
+
+## ============================================================================
+def read_run(run, number):
+    """ Reads a run spilled by an IndexBuilder
+
+        :param run: The run file
+        :param number: Position of the run, to sort equal keys
+        :returns: A generator of (key, number, row ids) tuples
+    """
+    while True:
+        try:
+            key, count = pickle.load(run)
+        except EOFError:
+            return
+        row_ids = array('I')
+        row_ids.fromfile(run, count)
+        yield key, number, row_ids
+
+## ============================================================================
+class Index():
+    """ Read only view of an index file. The keys and offsets are loaded in
+        memory, the postings are read from a memory map of the file
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, path, rank_path=None, first_row=0, rows_path=None):
+        """ :param path: The index file to load
+            :param rank_path: The rank file of the index, if it is needed
+            :param first_row: Row id of the first row in the index
+            :param rows_path: The rows file of an index that does not hold a
+                              contiguous range of rows (an upsert delta)
+        """
+        with open(path, 'rb') as idx_file:
+            keys_size, = HEADER.unpack(idx_file.read(HEADER.size))
+            self.keys = pickle.loads(idx_file.read(keys_size))
+            self.offsets = array('I')
+            self.offsets.fromfile(idx_file, len(self.keys) + 1)
+            self.base = idx_file.tell()
+            self.data = mmap.mmap(idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.rank_path = rank_path
+        self.first_row = first_row
+        self.rows_path = rows_path
+        self.row_ids = read_rows(rows_path) if rows_path else None
+        self.ranks = None
+
+    # -------------------------------------------------------------------------
+    def covers(self, row):
+        """ :returns: True if the row is indexed in this index
+        """
+        if self.row_ids is None:
+            return self.first_row <= row < self.first_row + self.offsets[-1]
+        slot = bisect_left(self.row_ids, row)
+        return slot < len(self.row_ids) and self.row_ids[slot] == row
+
+    # -------------------------------------------------------------------------
+    def rank(self, row):
+        """ :returns: The position in the index of the key of a row
+        """
+        if self.ranks is None:
+            with open(self.rank_path, 'rb') as rank_data:
+                self.ranks = mmap.mmap(rank_data.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.row_ids is None:
+            slot = row - self.first_row
+        else:
+            slot = bisect_left(self.row_ids, row)
+        return RANK.unpack_from(self.ranks, slot * RANK.size)[0]
+
+    # -------------------------------------------------------------------------
+    def postings(self, position):
+        """ :returns: An array with the row ids of the key in position
+        """
+        return self.rows(position, position + 1)
+
+    # -------------------------------------------------------------------------
+    def rows(self, begin, end):
+        """ :returns: An array with the row ids of the keys in the positions
+                      from begin to end (not included), in key order
+        """
+        if begin >= end:
+            return array('I')
+        return array('I', self.data[self.base + self.offsets[begin] * ITEM_SIZE:
+                                    self.base + self.offsets[end] * ITEM_SIZE])
+
+    # -------------------------------------------------------------------------
+    def count(self, begin, end):
+        """ :returns: The number of row ids of the keys in the positions from
+                      begin to end (not included)
+        """
+        return self.offsets[end] - self.offsets[begin] if begin < end else 0
+
+    # -------------------------------------------------------------------------
+    def find_range(self, low=None, high=None, low_inclusive=True,
+                   high_inclusive=True):
+        """ Finds the positions of the keys in a range with a binary search
+
+            :param low: Lower bound of the keys, None for no bound
+            :param high: Upper bound of the keys, None for no bound
+            :param low_inclusive: The range includes the lower bound
+            :param high_inclusive: The range includes the upper bound
+            :returns: A tuple with the begin and end (not included) positions
+        """
+        begin, end = 0, len(self.keys)
+        if low is not None:
+            search = bisect_left if low_inclusive else bisect_right
+            begin = search(self.keys, low)
+        if high is not None:
+            search = bisect_right if high_inclusive else bisect_left
+            end = search(self.keys, high)
+        return begin, max(begin, end)
+
+    # -------------------------------------------------------------------------
+    def find_prefix(self, prefix):
+        """ Finds the positions of the string keys starting with a prefix
+
+            :param prefix: The prefix to find
+            :returns: A tuple with the begin and end (not included) positions
+        """
+        begin = end = bisect_left(self.keys, prefix)
+        while end < len(self.keys) and self.keys[end].startswith(prefix):
+            end += 1
+        return begin, end
+
+    # -------------------------------------------------------------------------
+    def get(self, key, default=None):
+        """ Finds the row ids of a key with a binary search over the keys
+
+            :param key: The key to find
+            :param default: Value returned when the key is not in the index
+            :returns: An array with the row ids of the key
+        """
+        position = bisect_left(self.keys, key)
+        if position == len(self.keys) or self.keys[position] != key:
+            return default
+        return self.postings(position)
+
+    # -------------------------------------------------------------------------
+    def itervalues(self):
+        """ :returns: A generator of the row ids of every key, in key order
+        """
+        for position in xrange(len(self.keys)):
+            yield self.postings(position)
+
+    # -------------------------------------------------------------------------
+    def iteritems(self):
+        """ :returns: A generator of (key, row ids) tuples, in key order
+        """
+        for position, key in enumerate(self.keys):
+            yield key, self.postings(position)
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        self.data.close()
+        if self.ranks is not None:
+            self.ranks.close()
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.keys)
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        return 'Index(%i keys, %i rows)' % (len(self.keys), self.offsets[-1])
+
+## ============================================================================
+class MergedIndex(Index):
+    """ Read only view of a base index and the delta indexes of the rows
+        appended or upserted after it, as a single index. The postings of a
+        key are the postings of every part, in row order. When an upsert
+        rewrote a row, its postings in the older parts are left out
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, parts):
+        """ :param parts: The base index and the deltas, in row order
+        """
+        self.parts = parts
+        self.shadows = shadowed_rows([(p.first_row, p.row_ids) for p in parts])
+        self.keys = sorted(set().union(*[part.keys for part in parts]))
+        # Position in the merged keys of the keys of every part
+        self.positions = [array('I', [bisect_left(self.keys, k) for k in part.keys])
+                          for part in parts]
+
+    # -------------------------------------------------------------------------
+    def part_range(self, part, begin, end):
+        """ :returns: The positions in a part of the keys between the merged
+                      positions begin and end (not included)
+        """
+        if begin >= end:
+            return 0, 0
+        part_end = len(part.keys)
+        if end < len(self.keys):
+            part_end = bisect_left(part.keys, self.keys[end])
+        return bisect_left(part.keys, self.keys[begin]), part_end
+
+    # -------------------------------------------------------------------------
+    def rows(self, begin, end):
+        """ :returns: An array with the row ids of the keys in the positions
+                      from begin to end (not included). The rows of each
+                      part are in key order
+        """
+        rows = array('I')
+        for part, shadow in zip(self.parts, self.shadows):
+            part_rows = part.rows(*self.part_range(part, begin, end))
+            if shadow:
+                part_rows = [r for r in part_rows if r not in shadow]
+            rows.extend(part_rows)
+        if any(self.shadows) and end - begin == 1:
+            # Rewritten rows are not after the rows of the older parts
+            rows = array('I', sorted(rows))
+        return rows
+
+    # -------------------------------------------------------------------------
+    def count(self, begin, end):
+        """ :returns: The number of row ids of the keys in the positions
+                      from begin to end (not included). The stale postings
+                      of rewritten rows are counted, as an upper bound
+        """
+        return sum([part.count(*self.part_range(part, begin, end))
+                    for part in self.parts])
+
+    # -------------------------------------------------------------------------
+    def rank(self, row):
+        for part, positions in reversed(zip(self.parts, self.positions)):
+            if part.covers(row):
+                return positions[part.rank(row)]
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        for part in self.parts:
+            part.close()
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        return 'MergedIndex(%s)' % self.parts
+
+## ============================================================================
+class Indexes():
+    """ Indexes of a datastore, each one is loaded from its file the first
+        time it is used by the query. When rows were appended to the
+        datastore, the index of a column merges the delta indexes
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, prefix, column_names, deltas=[]):
+        """ :param prefix: Name of the datastore
+            :param column_names: Names of the indexed columns
+            :param deltas: List of (prefix, first row, upserted) of the delta
+                           indexes
+        """
+        self.prefix = prefix
+        self.column_names = column_names
+        self.deltas = delta_entries(deltas)
+        self.loaded = {}
+        self.lock = threading.Lock() # Shared by the query server threads
+
+    # -------------------------------------------------------------------------
+    def __contains__(self, column_name):
+        return column_name in self.column_names
+
+    # -------------------------------------------------------------------------
+    def __getitem__(self, column_name):
+        with self.lock:
+            if column_name not in self.loaded:
+                if column_name not in self.column_names:
+                    raise KeyError(column_name)
+                parts = []
+                for prefix, first_row, upserted in [(self.prefix, 0, False)] + self.deltas:
+                    parts.append(Index(index_file(prefix, column_name),
+                                       rank_file(prefix, column_name), first_row,
+                                       rows_file(prefix) if upserted else None))
+                index = parts[0] if len(parts) == 1 else MergedIndex(parts)
+                count_metric('index parts loaded', len(parts))
+                self.loaded[column_name] = index
+            return self.loaded[column_name]
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        return 'Indexes(%s, deltas: %s, loaded: %s)' % (self.column_names,
+                                                       self.deltas, self.loaded)
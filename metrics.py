@@ -0,0 +1,78 @@
+__all__ = ['enable_metrics', 'count', 'timer', 'output_metrics',
+           'start_profile', 'stop_profile']
+
+import sys
+import time
+
+## ============================================================================
+# Counters and timers of the import and query processes, shown with --stats.
+# They are disabled (None) by default, and updated once per batch of work
+# (a read of rows, a condition, a plan stage), never once per row, so they
+# cost nothing in the hot loops when disabled
+## ----------------------------------------------------------------------------
+COUNTERS = None
+TIMERS = None
+
+## ============================================================================
+def enable_metrics():
+    """ Starts collecting the counters and timers
+    """
+    global COUNTERS, TIMERS
+    COUNTERS, TIMERS = {}, {}
+
+## ============================================================================
+def count(name, value=1):
+    """ Adds a value to a counter, when the metrics are enabled
+    """
+    if COUNTERS is not None:
+        COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+## ============================================================================
+class timer():
+    """ Adds the time of a block to a timer, when the metrics are enabled:
+            with timer('filter'):
+                ...
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if TIMERS is not None:
+            self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if TIMERS is not None:
+            TIMERS[self.name] = TIMERS.get(self.name, 0) + time.time() - self.start
+
+## ============================================================================
+def output_metrics(stream=sys.stderr):
+    """ Prints the counters and timers, if they are enabled
+    """
+    if COUNTERS is None:
+        return
+    print >> stream, 'STATS'
+    for name, value in sorted(COUNTERS.iteritems()):
+        print >> stream, '%-24s %14i' % (name, value)
+    for name, value in sorted(TIMERS.iteritems()):
+        print >> stream, '%-24s %11.2f ms' % ('time ' + name, value * 1000)
+
+## ============================================================================
+def start_profile(path):
+    """ :returns: A running profiler when a dump file is given, else None
+    """
+    if not path:
+        return None
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+## ============================================================================
+def stop_profile(profiler, path):
+    """ Stops a profiler from start_profile and writes its dump file, to
+        read with pstats
+    """
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,207 @@
+__all__ = ['column_stats', 'estimate_rows', 'choose_access', 'choose_sort',
+           'Explain']
+
+from bisect import bisect_left
+import heapq
+import math
+import sys
+import time
+
+## ============================================================================
+# Statistics of an indexed column, gathered from the index at import time
+# and kept in the .ds file:
+#   rows: number of indexed rows
+#   distinct: number of distinct keys
+#   low: the smallest key
+#   histogram: equi-depth buckets, a list of (last key, rows up to that key)
+#   frequent: dictionary with the rows of the most frequent keys
+## ----------------------------------------------------------------------------
+HISTOGRAM_BUCKETS = 64
+FREQUENT_KEYS = 16
+
+## ============================================================================
+# Cost model of the operators, in microseconds per item, measured on the
+# benchmark datastore. Only the relative costs matter
+## ----------------------------------------------------------------------------
+POSTING_COST = 0.015   # Copy a row id from the postings of an index
+SORT_COST = 0.02       # Sort row ids, per k * log2(k)
+INTERSECT_COST = 0.07  # Intersect posting lists, per row id of both lists
+RANK_COST = 0.7        # Look up the rank of a row in a rank file
+SCAN_COST = 0.04       # Scan the rank file of every row with numpy
+KEY_COST = 1.5         # Build the sort key of a row, besides its ranks
+WALK_COST = 0.2        # Walk a posting of the index, checking the selection
+
+## ============================================================================
+def column_stats(index):
+    """ Gathers the statistics of a column from the sizes of the postings
+        of its index
+
+        :param index: The index of the column
+        :returns: Dictionary with the statistics of the column
+    """
+    offsets, keys = index.offsets, index.keys
+    num_rows = offsets[-1]
+    count = lambda position: offsets[position + 1] - offsets[position]
+    frequent = heapq.nlargest(FREQUENT_KEYS, xrange(len(keys)), key=count)
+    step = max(num_rows / HISTOGRAM_BUCKETS, 1)
+    histogram, position = [], 0
+    while position < len(keys):
+        # The bucket ends in the first key that reaches the rows of a step
+        end = min(bisect_left(offsets, offsets[position] + step, position + 1),
+                  len(keys))
+        histogram.append((keys[end - 1], offsets[end]))
+        position = end
+    return {'rows': num_rows, 'distinct': len(keys),
+            'low': keys[0] if keys else None, 'histogram': histogram,
+            'frequent': dict([(keys[p], count(p)) for p in frequent])}
+
+## ============================================================================
+def rows_below(stats, key, inclusive):
+    """ :returns: The estimated number of rows with a key lower than the given
+                  one (or equal, if inclusive)
+    """
+    histogram = stats['histogram']
+    if stats['low'] is None or key < stats['low']:
+        return 0
+    bucket = bisect_left(histogram, (key,))
+    if bucket == len(histogram):
+        return stats['rows']
+    before = histogram[bucket - 1][1] if bucket > 0 else 0
+    last_key, total = histogram[bucket]
+    if key == last_key:
+        return total if inclusive else total - stats['frequent'].get(key, 0)
+    return (before + total) / 2.0 # The key is inside the bucket
+
+## ============================================================================
+def estimate_rows(stats, num_rows, operator, values):
+    """ Estimates the rows matching a condition, scaled to the rows appended
+        since the statistics were gathered
+
+        :param stats: Statistics of the column, None if unknown
+        :param num_rows: Number of rows in the datastore
+        :param operator: The operator of the condition
+        :param values: The encoded values of the condition
+        :returns: The estimated number of rows
+    """
+    if stats is None or stats['rows'] == 0: # Every row was appended
+        return num_rows
+    if operator == '=':
+        key = values[0]
+        if key in stats['frequent']:
+            estimated = stats['frequent'][key]
+        elif stats['low'] is None or key < stats['low'] or key > stats['histogram'][-1][0]:
+            estimated = 0
+        else:
+            rest = stats['rows'] - sum(stats['frequent'].itervalues())
+            estimated = rest / float(max(stats['distinct'] - len(stats['frequent']), 1))
+    else:
+        low, high, low_inclusive, high_inclusive = None, None, True, True
+        if operator == '^=':
+            low, high = values[0], values[0] + '\xff'
+        elif operator in ['>', '>=']:
+            low, low_inclusive = values[0], operator == '>='
+        elif operator in ['<', '<=']:
+            high, high_inclusive = values[0], operator == '<='
+        else: # BETWEEN
+            low, high = values
+        below = 0 if low is None else rows_below(stats, low, not low_inclusive)
+        above = stats['rows'] if high is None else rows_below(stats, high, high_inclusive)
+        estimated = max(above - below, 0)
+    return int(round(estimated * num_rows / float(stats['rows'])))
+
+## ============================================================================
+def choose_access(selected, count, num_keys, num_rows, can_scan):
+    """ Chooses how to find the rows of a condition, by the cost of:
+          index: read the postings of the keys, and sort them by row when
+                 there are several keys
+          probe: keep the rows selected by the previous conditions whose
+                 rank is in the keys of the condition
+          scan: compare the rank of every row with the keys, with numpy
+
+        :param selected: The rows of the previous conditions, None if this
+                         is the first one
+        :param count: The rows of the keys of the condition
+        :param num_keys: The number of keys of the condition
+        :param num_rows: Number of rows in the datastore
+        :param can_scan: numpy is available
+        :returns: The chosen access and a dictionary with the costs
+    """
+    costs = {'index': count * POSTING_COST}
+    if num_keys > 1:
+        costs['index'] += count * math.log(count + 1, 2) * SORT_COST
+    if can_scan:
+        costs['scan'] = num_rows * SCAN_COST
+    if selected is not None:
+        for access in costs:
+            costs[access] += (len(selected) + count) * INTERSECT_COST
+        costs['probe'] = len(selected) * RANK_COST
+    return min(costs, key=costs.get), costs
+
+## ============================================================================
+def choose_sort(selected, num_columns, limit, num_rows):
+    """ Chooses how to sort the selected rows, by the cost of:
+          memory: sort the rows by their ranks in the order indexes
+          index: walk the postings of the first index in key order, up to
+                 the limit
+
+        :param selected: Number of selected rows
+        :param num_columns: Number of order columns
+        :param limit: Number of rows to return, None for all the rows
+        :param num_rows: Number of rows in the datastore
+        :returns: The chosen method and a dictionary with the costs
+    """
+    kept = selected if limit is None else min(limit, selected)
+    memory = selected * (KEY_COST + num_columns * RANK_COST)
+    memory += selected * math.log(kept + 1, 2) * SORT_COST
+    walked = num_rows
+    if limit is not None:
+        # The selected rows are assumed to be spread over the index
+        walked = min(num_rows, limit * num_rows / float(max(selected, 1)))
+    costs = {'memory': memory, 'index': walked * WALK_COST}
+    return min(costs, key=costs.get), costs
+
+## ============================================================================
+class Explain():
+    """ Records the operators of a query, with their estimated and actual
+        rows and their time, to print them as an EXPLAIN
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self):
+        self.operators = []
+
+    # -------------------------------------------------------------------------
+    def start(self, name, detail, estimated):
+        """ Starts timing an operator
+
+            :param name: Name of the operator
+            :param detail: Description of what the operator does
+            :param estimated: Estimated rows, None if not estimated
+            :returns: The operator record, to finish it
+        """
+        operator = {'name': name, 'detail': detail, 'estimated': estimated,
+                    'actual': None, 'time': None, 'start': time.time()}
+        self.operators.append(operator)
+        return operator
+
+    # -------------------------------------------------------------------------
+    def finish(self, operator, actual):
+        """ Finishes timing an operator with its actual rows
+        """
+        operator['actual'] = actual
+        operator['time'] = time.time() - operator['start']
+
+    # -------------------------------------------------------------------------
+    def output(self, stream=sys.stderr):
+        """ Prints the operators, in the order they ran
+        """
+        print >> stream, 'EXPLAIN'
+        print >> stream, '%-12s %10s %10s %10s  %s' % ('operator', 'estimated',
+                                                      'actual', 'time (ms)', 'detail')
+        for operator in self.operators:
+            print >> stream, '%-12s %10s %10s %10s  %s' % (
+                operator['name'],
+                '-' if operator['estimated'] is None else operator['estimated'],
+                '-' if operator['actual'] is None else operator['actual'],
+                '-' if operator['time'] is None else '%.2f' % (operator['time'] * 1000),
+                operator['detail'])
@@ -0,0 +1,60 @@
+__all__ = ['intersect', 'union']
+
+from bisect import bisect_left
+
+## ============================================================================
+# When a posting list is this many times longer than the other one, the
+# intersection gallops over it instead of hashing both lists
+## ----------------------------------------------------------------------------
+GALLOP_RATIO = 16
+
+## ============================================================================
+def gallop(short, long):
+    """ Intersects two sorted posting lists, searching each row of the short
+        list in the long one with an exponential search from the last match
+
+        :param short: The shorter sorted list of row ids
+        :param long: The longer sorted list of row ids
+        :returns: A sorted list with the common row ids
+    """
+    result, low, size = [], 0, len(long)
+    for row in short:
+        bound = 1
+        while low + bound < size and long[low + bound] < row:
+            bound *= 2
+        low = bisect_left(long, row, low + bound / 2, min(low + bound + 1, size))
+        if low == size:
+            break
+        if long[low] == row:
+            result.append(row)
+    return result
+
+## ============================================================================
+def intersect(lists):
+    """ Intersects sorted posting lists, from the shortest to the longest, so
+        the cost follows the size of the shortest one
+
+        :param lists: Sorted lists of row ids
+        :returns: A sorted list with the row ids present in every list
+    """
+    lists = sorted(lists, key=len)
+    result = lists[0]
+    for other in lists[1:]:
+        if not result:
+            break
+        if len(other) > GALLOP_RATIO * len(result):
+            result = gallop(result, other)
+        else:
+            result = sorted(set(result).intersection(other))
+    return list(result)
+
+## ============================================================================
+def union(lists):
+    """ Merges sorted posting lists
+
+        :param lists: Sorted lists of row ids
+        :returns: A sorted list with the row ids present in any list
+    """
+    if len(lists) == 1:
+        return list(lists[0])
+    return sorted(set().union(*lists))
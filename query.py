@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 
+import re
 import sys
+import heapq
 import pickle
-import itertools
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
 from util import *
-
-chain = itertools.chain.from_iterable # to flatten the rows array from each index
+from util import Char
+from storage import ZONE_TYPES, open_reader, dictionary_columns, load_schema
+from index import Indexes, check_index_format
+from postings import intersect, union
+from vector import can_scan, can_vectorize, execute_vectorized, scan_ranks
+from planner import Explain, estimate_rows, choose_access, choose_sort
+from metrics import count as count_metric, timer, enable_metrics, output_metrics, \
+    start_profile, stop_profile
 
 ## ============================================================================
 def read_datastore(options):
@@ -17,86 +27,289 @@ def read_datastore(options):
     try:
         ds_file = open('%s.ds' % options.input, 'rb') 
         datastore = pickle.load(ds_file)
-        debug('Loaded datastore %s' % str(datastore), options.verbose)
+        check_index_format(datastore, options.input)
+        datastore.setdefault('layout', 'row')
+        datastore.setdefault('schema', DEFAULT_DEFINITIONS)
+        datastore['encoded'] = dictionary_columns(datastore)
+        load_schema(datastore)
+        datastore['indexes'] = Indexes(datastore['datafile'], datastore['indexes'],
+                                       datastore.get('deltas', []))
+        debug('Loaded datastore %s', options.verbose, datastore)
         ds_file.close()
         return datastore
     except IOError as e:
         error('Unable to load datastore: %s' % e)
 
 ## ============================================================================
-def build_order_by(order_by, filtered_rows, datastore, options):
+def sort_rows(rows, order, limit):
+    """ Sorts rows in memory by the rank of their keys in each index. Rows
+        with the same keys keep the row order
+
+        :param rows: The rows to sort
+        :param order: List of (index, descending) tuples
+        :param limit: Number of rows to return, None for all the rows
+        :returns: The sorted rows
+    """
+    def sort_key(row):
+        return [-index.rank(row) if descending else index.rank(row)
+                for index, descending in order] + [row]
+    if limit is not None:
+        return heapq.nsmallest(limit, rows, key=sort_key)
+    return sorted(rows, key=sort_key)
+
+## ============================================================================
+def walk_index(rows, order, limit, num_rows):
+    """ Sorts rows walking the first index in key order and keeping the rows
+        of each key that are in the selection. Rows with the same key are
+        sorted in memory by the rest of the columns. Stops after limit rows
+
+        :param rows: The rows to sort
+        :param order: List of (index, descending) tuples
+        :param limit: Number of rows to return, None for all the rows
+        :param num_rows: Number of rows in the datastore
+        :returns: The sorted rows
+    """
+    selected = set(rows) if len(rows) < num_rows else None
+    index, descending = order[0]
+    positions = xrange(len(index))
+    if descending:
+        positions = reversed(positions)
+    ordered = []
+    for position in positions:
+        key_rows = index.postings(position)
+        if selected is not None:
+            key_rows = [row for row in key_rows if row in selected]
+        if len(key_rows) > 1 and len(order) > 1:
+            key_rows = sort_rows(key_rows, order[1:], None)
+        ordered.extend(key_rows)
+        if limit is not None and len(ordered) >= limit:
+            return ordered[:limit]
+    return ordered
+
+## ============================================================================
+def build_order_by(order_by, filtered_rows, limit, datastore, options, explain):
     """ Orders the filtered (or all) columns according to the exptected
-        order from the command line.
+        order from the command line. The rows are sorted in memory by the
+        row ranks of the indexes, or walking the index of the first column,
+        by the cost of each method (see planner.choose_sort)
 
-        :param order_by: The order from the command line
+        :param order_by: List of (column, descending) tuples
         :param filtered_rows: The rows to order, all if no order was given
+        :param limit: Number of rows to return, None for all the rows
         :param datastore: Current datastore
         :param options: Command line arguments 
+        :param explain: Explain recording the operators
         :returns: The row index to select, now in order
     """
     if len(order_by) == 0:
-        return filtered_rows
-    debug('Ordering by columns %s' % str(order_by), options.verbose)
-    num_rows = 0
-    flat_rows = []
-    for column in order_by: # Reshape the index rows list to sort by column
-        index = datastore['indexes'][column.name]
-        # index_rows is a list of tuples in the form (num_row, row)  
-        # further sorting must be based on the num_row value,
-        # preserving the row value for the actual result
-        index_rows = [(i, v) for i, v in enumerate(list(chain(index.itervalues())))
-                      if v in filtered_rows]
-        flat_rows.extend(index_rows)
-        num_rows = len(index_rows)
-    # Actual reshape is done over the flat rows, in a slice-n-dice operation
-    # to rearange rows in a matrix in the same shape of the resultset
-    columns = [flat_rows[row::num_rows] for row in range(num_rows)]
-    debug('columns: %s' % str(columns), options.verbose)
-    # Finally, the sorting. From leat-significant column to the most
-    # In each row there is a tuple in the form (num_row, row), so the
-    # second (1) value of the tuple is used to do the sort.
-    for idx in reversed(range(len(order_by))):
-        columns.sort(key=lambda c: c[idx][0])
-    debug('columns (sorted): %s' % str(columns), options.verbose)
-    # Once the columns are sorted, the most-signinficant row is in index 0
-    # and the actual column to fetch is in position 1 of the tuple.
-    return [column[0][1] for column in columns]
-
-## ============================================================================
-def build_filter(filters, datastore, options):
-    """ Finds the columns to fetch according to the requested filters 
-
-        :param filters: The parsed filters
+        return filtered_rows if limit is None else list(islice(filtered_rows, limit))
+    debug('Ordering by columns %s', options.verbose, order_by)
+    order = [(datastore['indexes'][c.name], d) for c, d in order_by]
+    num_rows, selected = datastore['num_rows'], len(filtered_rows)
+    method, costs = choose_sort(selected, len(order), limit, num_rows)
+    debug('Costs of the order: %s', options.verbose, costs)
+    operator_record = explain.start('Sort', '%s by %s' % (','.join(
+        ['%s%s' % (c.name, ':desc' if d else '') for c, d in order_by]), method),
+        selected if limit is None else min(selected, limit))
+    if method == 'memory':
+        count_metric('rank lookups', selected * len(order))
+        rows = sort_rows(filtered_rows, order, limit)
+    else:
+        rows = walk_index(filtered_rows, order, limit, num_rows)
+    explain.finish(operator_record, len(rows))
+    return rows
+
+## ============================================================================
+def condition_bounds(operator, values):
+    """ :returns: The range of the encoded values matching a condition (not
+                  a prefix one), as a tuple with the low and high values
+                  (None for no bound) and if they are included
+    """
+    if operator == '=':
+        return values[0], values[0], True, True
+    if operator == '<':
+        return None, values[0], True, False
+    if operator == '<=':
+        return None, values[0], True, True
+    if operator == '>':
+        return values[0], None, False, True
+    if operator == '>=':
+        return values[0], None, True, True
+    if operator == 'BETWEEN':
+        return values[0], values[1], True, True
+
+## ============================================================================
+def find_keys(index, operator, values):
+    """ Finds the keys matching a condition with a binary search over the
+        sorted keys of the index
+
+        :param index: Index of the filtered column
+        :param operator: The operator of the condition
+        :param values: The encoded values of the condition
+        :returns: The begin and end (not included) positions of the keys
+    """
+    if operator == '^=':
+        return index.find_prefix(values[0])
+    return index.find_range(*condition_bounds(operator, values))
+
+## ============================================================================
+def format_condition(column, operator, values):
+    """ :returns: The text of a parsed condition, for the EXPLAIN output
+    """
+    values = [column.type.decode(v).format() for v in values]
+    if operator == 'BETWEEN':
+        return '%s BETWEEN %s AND %s' % (column.name, values[0], values[1])
+    return '%s%s%s' % (column.name, operator, values[0])
+
+## ============================================================================
+def build_filter(filters, datastore, options, explain):
+    """ Finds the columns to fetch according to the requested filters. The
+        conditions of each group run from the one with less estimated rows,
+        according to the statistics of the columns, and each one finds its
+        rows with the access of less cost (see planner.choose_access). In
+        the block layout, the index access of a range of a zone column uses
+        the zone maps when they need less rows to be read. The rows of the
+        groups are merged
+
+        :param filters: The parsed filters, a list of groups of conditions
         :param datastore: Current datastore
         :param options: Command line arguments 
-        :returns: A list with the columns to fetch 
+        :param explain: Explain recording the operators
+        :returns: A list with the columns to fetch, in row order, or an
+                  xrange of every row when there is no filter
     """
     if len(filters) == 0:
-        return range(datastore['num_rows']) 
-    debug('Filtering by %s' % str(filters), options.verbose)
-    filtered_columns = []
-    for column, value in filters:
-        if column.name not in datastore['indexes']:
-            error('Filtering is only supported on indexed columns (%s)' % column.name)
-        index = datastore['indexes'][column.name]
-        col_values = index.get(value, [])
-        debug('Selected columns for value %s: %s' % (value, col_values), options.verbose)
-        filtered_columns.extend(col_values)
-    return filtered_columns
+        return xrange(datastore['num_rows'])
+    debug('Filtering by %s', options.verbose, filters)
+    num_rows, stats = datastore['num_rows'], datastore.get('stats', {})
+    blocks = None
+    if datastore['layout'] == 'block':
+        blocks = open_reader(datastore, options)
+    groups = []
+    for conditions in filters:
+        planned = []
+        for column, operator, values in conditions:
+            if column.name not in datastore['indexes']:
+                error('Filtering is only supported on indexed columns (%s)' % column.name)
+            estimated = estimate_rows(stats.get(column.name), num_rows, operator, values)
+            planned.append((estimated, column, operator, values))
+        planned.sort(key=lambda p: p[0])
+        rows = None
+        for estimated, column, operator, values in planned:
+            index = datastore['indexes'][column.name]
+            begin, end = find_keys(index, operator, values)
+            count = index.count(begin, end)
+            access, costs = choose_access(rows, count, end - begin, num_rows,
+                                          can_scan(options))
+            debug('Costs of %s: %s', options.verbose, column.name, costs)
+            key_rows = None
+            if access == 'index' and blocks is not None and column.type in ZONE_TYPES \
+               and operator != '^=':
+                key_rows = blocks.zone_rows(column, condition_bounds(operator, values),
+                                            count)
+                if key_rows is not None:
+                    access = 'zones'
+            operator_record = explain.start('Filter', '%s by %s' % (
+                format_condition(column, operator, values), access), estimated)
+            count_metric('index lookups')
+            count_metric('%s accesses' % access)
+            if access == 'probe':
+                count_metric('rank lookups', len(rows))
+                rows = [row for row in rows if begin <= index.rank(row) < end]
+            else:
+                if access == 'scan':
+                    key_rows = scan_ranks(index, num_rows, begin, end)
+                elif access == 'index':
+                    # The rows of several keys are in key order, sort them by row
+                    key_rows = index.rows(begin, end)
+                    count_metric('postings read', len(key_rows))
+                    if end - begin > 1:
+                        key_rows = sorted(key_rows)
+                rows = key_rows if rows is None else intersect([rows, key_rows])
+            explain.finish(operator_record, len(rows))
+            if not rows:
+                break
+        groups.append(rows)
+    if blocks is not None:
+        blocks.close()
+    if len(groups) == 1:
+        return union(groups)
+    operator_record = explain.start('Union', '%i groups' % len(groups),
+                                    min(sum([len(g) for g in groups]), num_rows))
+    rows = union(groups)
+    explain.finish(operator_record, len(rows))
+    return rows
+
+## ============================================================================
+FILTER_SYNTAX = re.compile(r'^(\w+)(<=|>=|\^=|<|>|=)(.*)$')
+BETWEEN_SYNTAX = re.compile(r'^(\w+)\s+BETWEEN\s+(.+?)\s+AND\s+(.+)$', re.IGNORECASE)
+BETWEEN_START = re.compile(r'^\w+\s+BETWEEN\s+((?!\s+AND\s+).)+$', re.IGNORECASE)
+# AND and OR must be upper case, so text values like 'rock and roll' work
+AND_SYNTAX = re.compile(r',|\s+AND\s+')
+OR_SYNTAX = re.compile(r'\s+OR\s+')
+
+## ============================================================================
+def encode_value(column, value):
+    """ Converts a value from the command line to the encoding of the index
+        keys, so the comparisons follow the column type
+
+        :param column: The filtered column
+        :param value: The value from the command line
+        :returns: The encoded value
+    """
+    try:
+        return column.type(value).encode()
+    except ValueError:
+        error('Invalid value for column %s: %s' % (column.name, value))
 
 ## ============================================================================
 def parse_filter(condition, options):
-    """ Parse the filter condition from the comand line arguments.
+    """ Parse the filter condition from the comand line arguments. The
+        condition can be COL=value, COL<value, COL<=value, COL>value,
+        COL>=value, COL^=prefix or COL BETWEEN low AND high
 
         :param condition: The condition from the command line
         :param options: Command line arguments 
-        :returns: The filtered column and the value to select
+        :returns: The filtered column, the operator and the encoded values
     """
-    items = condition.split('=')
-    if len(items) != 2:
+    between = BETWEEN_SYNTAX.match(condition)
+    if between:
+        column = column_by_name(between.group(1), fail=True)
+        values = [between.group(2), between.group(3)]
+        return column, 'BETWEEN', [encode_value(column, v) for v in values]
+    match = FILTER_SYNTAX.match(condition)
+    if not match:
         error('Invalid filter sintax: %s' % condition)
-    column = column_by_name(items[0], fail=True)
-    return column, items[1]
+    column = column_by_name(match.group(1), fail=True)
+    operator, value = match.group(2), match.group(3)
+    if operator == '^=' and column.type != Char:
+        error('Prefix filters are only supported on text columns (%s)' % column.name)
+    return column, operator, [encode_value(column, value)]
+
+## ============================================================================
+def parse_filters(expression, options):
+    """ Parse the filter expression from the command line arguments. The
+        expression is a list of groups separated by OR, and each group is a
+        list of conditions separated by commas or AND
+
+        :param expression: The filter expression from the command line
+        :param options: Command line arguments 
+        :returns: A list with the conditions of each group
+    """
+    filters = []
+    for group in OR_SYNTAX.split(expression):
+        conditions, pending = [], ''
+        for term in AND_SYNTAX.split(group):
+            # The AND of a BETWEEN belongs to the condition
+            if pending and BETWEEN_START.match(pending):
+                pending = '%s AND %s' % (pending, term)
+                continue
+            if pending:
+                conditions.append(parse_filter(pending, options))
+            pending = term
+        conditions.append(parse_filter(pending, options))
+        filters.append(conditions)
+    return filters
 
 ## ============================================================================
 def parse_select_term(term, options):
@@ -115,9 +328,26 @@ def parse_select_term(term, options):
         error('Invalid aggregate syntax: %s' % term)
     col_name, aggregate = tuple(term.split(':'))
     column = column_by_name(col_name, fail=True)
-    debug('using aggregate %s for column %s' % (aggregate, col_name), options.verbose)
+    debug('using aggregate %s for column %s', options.verbose, aggregate, col_name)
     return column, aggregate
 
+## ============================================================================
+def parse_order_term(term, options):
+    """ Parse an order column from the command line. It can be plain like
+        DATE, DATE:asc or DATE:desc
+
+        :input term: The order term from command line
+        :param options: Command line arguments 
+        :returns: A tuple with the column and True for descending order
+    """
+    col_name, _, direction = term.partition(':')
+    if direction.lower() not in ['', 'asc', 'desc']:
+        error('Invalid order direction: %s' % term)
+    column = column_by_name(col_name, fail=True)
+    if not column.is_index:
+        error('Ordering by not index column (%s) is not supported' % column.name)
+    return column, direction.lower() == 'desc'
+
 ## ============================================================================
 def build_plan(datastore, options):
     """ Build execution plan according to the arguments given from the user
@@ -127,65 +357,364 @@ def build_plan(datastore, options):
         :returns: A dictionary containing the processed columns, orders and
                   filters to select from the datasore
     """
-    debug('creating plan for %s' % options.select, options.verbose)
-    columns, indexes, filters, order_by = [], [], [], []
+    debug('creating plan for %s', options.verbose, options.select)
+    columns, indexes, filters, order_by, group_by = [], [], [], [], []
     for column_name in options.select.split(','):
         if '*' == column_name: # Support for all columns in the datastore
-            columns.extend([SelectColumn(c) for c in COLUMNS])
+            columns.extend([SelectColumn(c) for c in SCHEMA.columns])
         else:
             column, aggregate = parse_select_term(column_name, options)
             columns.append(SelectColumn(column, aggregate))
             if column.is_index: 
                 indexes.append(column)
-    for column_name in options.order.split(',') if options.order != '' else []:
-        column = column_by_name(column_name, fail=True)
-        if not column.is_index:
-            error('Ordering by not index column (%s) is not supported' % column.name)
-        order_by.append(column)
-    for condition in options.filter.split(',') if options.filter != '' else []:
-        filters.append(parse_filter(condition, options))
-    filtered_rows = build_filter(filters, datastore, options)
-    ordered_rows = build_order_by(order_by, filtered_rows, datastore, options)
-    return {'columns': columns, 'indexes': indexes, 
-            'rows': ordered_rows, 'order_by': order_by}
+    for term in options.order.split(',') if options.order != '' else []:
+        order_by.append(parse_order_term(term, options))
+    for column_name in options.group.split(',') if options.group != '' else []:
+        group_by.append(column_by_name(column_name, fail=True))
+    for column in columns if group_by else []:
+        if column.aggregate == '' and column.column not in group_by:
+            error('Column %s must be aggregated or in the group' % column.name)
+    if options.filter != '':
+        filters = parse_filters(options.filter, options)
+    explain = Explain()
+    with timer('filter'):
+        filtered_rows = build_filter(filters, datastore, options, explain)
+    # The limit of an aggregate applies to its result rows, in execute
+    aggregated = group_by or any([c.aggregate != '' for c in columns])
+    limit = None if aggregated else options.limit or None
+    with timer('order'):
+        ordered_rows = build_order_by(order_by, filtered_rows, limit, datastore,
+                                      options, explain)
+    return {'columns': columns, 'indexes': indexes, 'explain': explain,
+            'rows': ordered_rows, 'order_by': order_by, 'group_by': group_by}
+
+## ============================================================================
+def new_states(columns):
+    """ :returns: New select columns, to hold the aggregates of a group
+    """
+    return [SelectColumn(c.column, c.aggregate) for c in columns]
+
+## ============================================================================
+def aggregate_index(plan, reader, datastore, options):
+    """ Aggregates the rows by a single indexed column, walking its index in
+        key order. The group value comes from the index key, so the group
+        column is not read from the data file
+
+        :param plan: Dictionary with the requested query
+        :param reader: Reader of the datastore
+        :param datastore: Current datastore
+        :param options: Command line arguments 
+        :returns: The select columns of each group, in key order
+    """
+    group = plan['group_by'][0]
+    index = datastore['indexes'][group.name]
+    rows = plan['rows']
+    selected = set(rows) if len(rows) < datastore['num_rows'] else None
+    groups = []
+    for position, key in enumerate(index.keys):
+        key_rows = index.postings(position)
+        if selected is not None:
+            key_rows = [row for row in key_rows if row in selected]
+        if len(key_rows) == 0:
+            continue
+        states = new_states(plan['columns'])
+        data_columns = []
+        for state in states:
+            if state.aggregate == '': # Plain columns are the group column
+                state.add_parsed(group.type.decode(key))
+            else:
+                data_columns.append(state)
+        for row, values in reader.read(key_rows, data_columns):
+            for column, value in zip(data_columns, values):
+                column.add_parsed(value)
+        groups.append(states)
+    return groups
+
+## ============================================================================
+def aggregate_hash(plan, reader, datastore, options):
+    """ Aggregates the rows by the group columns in a single pass, keeping
+        the select columns of each group in a hash table
+
+        :param plan: Dictionary with the requested query
+        :param reader: Reader of the datastore
+        :param datastore: Current datastore
+        :param options: Command line arguments 
+        :returns: The select columns of each group, sorted by group key
+    """
+    groups = hash_groups(plan, reader)
+    return [groups[key] for key in sorted(groups.iterkeys())]
+
+## ============================================================================
+def hash_groups(plan, reader):
+    """ :returns: A dictionary with the select columns of each group, by the
+                  encoded values of the group columns
+    """
+    group_by, columns = plan['group_by'], plan['columns']
+    num_groups = len(group_by)
+    groups = {}
+    for row, values in reader.read(plan['rows'], group_by + columns):
+        group_values = values[:num_groups]
+        key = tuple([v.encode() for v in group_values])
+        states = groups.get(key)
+        if states is None:
+            states = groups[key] = new_states(columns)
+            for state in states:
+                if state.aggregate == '': # Plain columns are group columns
+                    state.add_parsed(group_values[group_by.index(state.column)])
+        for state, value in zip(states, values[num_groups:]):
+            if state.aggregate != '':
+                state.add_parsed(value)
+    return groups
+
+## ============================================================================
+# Parallel execution (--jobs). The selected rows are split in contiguous
+# partitions, read by a pool of processes that open their own reader. The
+# plain rows of each partition come back formatted, in the order of the
+# plan, and the aggregates as partial values that are merged by group
+## ----------------------------------------------------------------------------
+PARTITION_ROWS = 16384 # Plain rows, aggregates take a partition per job
+PARALLEL_ROWS = 16384 # Smaller selections are read by the query process
+WORKER = {} # The reader of a worker process
+
+## ============================================================================
+def use_jobs(plan, options):
+    """ :returns: True if the selected rows are read by a pool of processes
+    """
+    return options.jobs > 1 and len(plan['rows']) >= PARALLEL_ROWS
+
+## ============================================================================
+def split_rows(rows, jobs, max_rows=None):
+    """ Splits the selected rows in contiguous partitions, one per job or
+        more if they are over max_rows. An unfiltered scan is split in ranges
+        of row ids
+
+        :param rows: The selected rows, in the order of the plan
+        :param jobs: Number of processes
+        :param max_rows: Maximum rows of a partition, None for no limit
+        :returns: A list with the rows of each partition
+    """
+    size = max((len(rows) + jobs - 1) / jobs, 1)
+    if max_rows is not None:
+        size = min(size, max_rows)
+    bounds = [(begin, min(begin + size, len(rows))) for begin in xrange(0, len(rows), size)]
+    if isinstance(rows, xrange):
+        return [xrange(rows[begin], rows[end - 1] + 1) for begin, end in bounds]
+    return [rows[begin:end] for begin, end in bounds]
+
+## ============================================================================
+def start_worker(datastore, options):
+    """ Loads the schema and opens the reader of a worker process
+    """
+    load_schema(datastore)
+    WORKER['reader'] = open_reader(datastore, options)
+
+## ============================================================================
+def read_partition(task):
+    """ Reads a partition of the selected rows in a worker process
+
+        :param task: Tuple with the select columns, as (name, aggregate)
+                     tuples, the names of the group columns and the rows
+        :returns: The formatted rows when no column is aggregated, else a
+                  dictionary with the partial aggregates of the select
+                  columns of each group
+    """
+    terms, group_names, rows = task
+    columns = [SelectColumn(column_by_name(name), aggregate) for name, aggregate in terms]
+    if not group_names and all([c.aggregate == '' for c in columns]):
+        return [[value.format() for value in values]
+                for row, values in WORKER['reader'].read(rows, columns)]
+    plan = {'columns': columns, 'rows': rows,
+            'group_by': [column_by_name(name) for name in group_names]}
+    return {key: [state.partial() for state in states]
+            for key, states in hash_groups(plan, WORKER['reader']).iteritems()}
+
+## ============================================================================
+def map_partitions(plan, datastore, options):
+    """ Reads the partitions of the selected rows with a pool of
+        options.jobs processes
+
+        :param plan: Dictionary with the requested query
+        :param datastore: Current datastore
+        :param options: Command line arguments
+        :returns: A generator of the results of read_partition, in the order
+                  of the partitions
+    """
+    files = {key: datastore[key]
+             for key in ['datafile', 'layout', 'num_rows', 'schema', 'encoded']}
+    terms = [(c.name, c.aggregate) for c in plan['columns']]
+    group_names = [c.name for c in plan['group_by']]
+    aggregated = group_names or any([aggregate != '' for _, aggregate in terms])
+    partitions = split_rows(plan['rows'], options.jobs,
+                            None if aggregated else PARTITION_ROWS)
+    tasks = [(terms, group_names, rows) for rows in partitions]
+    debug('reading %i partitions with %i jobs', options.verbose, len(tasks), options.jobs)
+    pool = Pool(options.jobs, start_worker, (files, options))
+    pending = deque() # At most two partitions per job are held in memory
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(read_partition, (task,)))
+            if len(pending) == 2 * options.jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+## ============================================================================
+def aggregate_parallel(plan, datastore, options):
+    """ Aggregates the selected rows with a pool of processes, merging the
+        partial aggregates of every partition in order. Without group
+        columns, the aggregates are merged in the select columns of the plan
+
+        :param plan: Dictionary with the requested query
+        :param datastore: Current datastore
+        :param options: Command line arguments
+        :returns: The select columns of each group, sorted by group key
+    """
+    groups = {} if plan['group_by'] else {(): plan['columns']}
+    for partial_groups in map_partitions(plan, datastore, options):
+        for key, partials in partial_groups.iteritems():
+            states = groups.get(key)
+            if states is None:
+                states = groups[key] = new_states(plan['columns'])
+            elif plan['group_by']: # Plain columns hold the group values
+                partials = [None if s.aggregate == '' else p
+                            for s, p in zip(states, partials)]
+            for state, partial in zip(states, partials):
+                state.merge(partial)
+    return [groups[key] for key in sorted(groups.iterkeys())]
+
+## ============================================================================
+# The result rows are written to the output in chunks of this many rows
+## ----------------------------------------------------------------------------
+OUTPUT_CHUNK = 4096
 
 ## ============================================================================
 def execute(plan, datastore, options):
-    """ Execute query based on the current plan
+    """ Execute query based on the current plan. The rows of a query without
+        aggregates are streamed from the reader, so they are never held in
+        memory; aggregates are computed over every selected row before the
+        first row is returned, and the limit cuts their result rows.
+        With --jobs, large selections are read by a pool of processes
 
         :param plan: Dictionary with the requested query
         :param datastore: Current datastore
         :param options: Command line arguments 
+        :returns: A generator of the result rows, as lists of formatted values
     """
-    if options.show_plan:
-        debug('Executing plan %s' % str(plan), True)
-    datafile = open(datastore['datafile'], 'r')
-    for row in plan['rows']: 
-        debug('parsing row %i' % row, options.verbose)
-        # Get the start position of the current selected row
-        line_begin = row * ROW_SIZE
-        for column in plan['columns']:
-            # Read the data according to the field size
-            datafile.seek(line_begin + column.offset)
-            data = datafile.read(column.size).strip()
-            column.add_value(data)
-            debug('read [%s] for column %s' % (data, column.name), options.verbose)
-    datafile.close()
-
-## ============================================================================
-def output_resultset(datastore, plan, options):
-    """ Prints the resultset to the standard input
+    group_by, explain = plan['group_by'], plan['explain']
+    selected = len(plan['rows'])
+    if not group_by and all([c.aggregate == '' for c in plan['columns']]) \
+       and not can_vectorize(plan, datastore, options):
+        names = ','.join([c.name for c in plan['columns']])
+        num_read, verbose = 0, options.verbose
+        if use_jobs(plan, options):
+            operator_record = explain.start('Read', '%s with %i jobs' % (
+                names, options.jobs), selected)
+            try:
+                for rows in map_partitions(plan, datastore, options):
+                    for row in rows:
+                        num_read += 1
+                        yield row
+            finally:
+                explain.finish(operator_record, num_read)
+                count_metric('rows read', num_read)
+            return
+        reader = open_reader(datastore, options)
+        operator_record = explain.start('Read', '%s with %s' % (
+            names, reader.__class__.__name__), selected)
+        try:
+            for row, values in reader.read(plan['rows'], plan['columns']):
+                if verbose:
+                    debug('parsing row %i', verbose, row)
+                num_read += 1
+                yield [value.format() for value in values]
+        finally:
+            reader.close()
+            explain.finish(operator_record, num_read)
+            count_metric('rows read', num_read)
+        return
+    # Groups estimated from the distinct keys of the group columns
+    stats, num_groups = datastore.get('stats', {}), 1
+    for column in group_by:
+        num_groups *= stats.get(column.name, {}).get('distinct', selected)
+    num_groups = min(num_groups, selected)
+    if can_vectorize(plan, datastore, options):
+        debug('Using the vectorized engine', options.verbose)
+        operator_record = explain.start('Aggregate', 'vectorized', num_groups)
+        execute_vectorized(plan, datastore, options)
+        count_metric('rows aggregated', selected)
+    elif use_jobs(plan, options):
+        operator_record = explain.start('Aggregate', 'hash with %i jobs' % options.jobs,
+                                        num_groups)
+        groups = aggregate_parallel(plan, datastore, options)
+        if group_by:
+            plan['groups'] = groups
+        count_metric('rows aggregated', selected)
+    else:
+        reader = open_reader(datastore, options)
+        # The index walk reads the rows in key order, which would decompress
+        # the blocks again for every key
+        if len(group_by) == 1 and group_by[0].name in datastore['indexes'] \
+           and datastore['layout'] != 'block':
+            operator_record = explain.start('Aggregate', 'index walk of %s with %s' % (
+                group_by[0].name, reader.__class__.__name__), num_groups)
+            plan['groups'] = aggregate_index(plan, reader, datastore, options)
+        elif group_by:
+            operator_record = explain.start('Aggregate', 'hash with %s' %
+                                            reader.__class__.__name__, num_groups)
+            plan['groups'] = aggregate_hash(plan, reader, datastore, options)
+        else:
+            operator_record = explain.start('Aggregate', 'scan with %s' %
+                                            reader.__class__.__name__, num_groups)
+            verbose = options.verbose
+            for row, values in reader.read(plan['rows'], plan['columns']):
+                if verbose:
+                    debug('parsing row %i', verbose, row)
+                for column, value in zip(plan['columns'], values):
+                    column.add_parsed(value)
+        reader.close()
+        count_metric('rows aggregated', selected)
+    explain.finish(operator_record, len(plan['groups']) if group_by else 1)
+    limit = options.limit or None
+    if group_by:
+        for states in islice(plan['groups'], limit):
+            yield [column.values()[0] for column in states]
+    else:
+        for row in islice(zip(*[column.values() for column in plan['columns']]), limit):
+            yield list(row)
+
+## ============================================================================
+def output_resultset(datastore, plan, rows, options, stream=sys.stdout):
+    """ Prints the resultset to the standard output. The first row is
+        written as soon as it is available, and the rest in chunks of
+        OUTPUT_CHUNK rows
 
         :param datastore: Current datastore
         :param plan: Current query plan 
+        :param rows: The result rows, from execute
         :param options: Command line arguments 
+        :param stream: Stream to write the resultset to
     """
-    values = zip(*[column.values() for column in plan['columns']])
-    output = '\n'.join([','.join(row) for row in values])
-    print >> sys.stdout, ','.join([column.format_name() for column in plan['columns']])
-    print >> sys.stdout, output
-    lr = len(values) 
-    debug('(%i record%s found)' % (lr, 's' if lr > 1 else ''), options.verbose)
+    print >> stream, ','.join([column.format_name() for column in plan['columns']])
+    chunk, lr = [], 0
+    try:
+        for row in rows:
+            chunk.append(','.join(row))
+            if len(chunk) == OUTPUT_CHUNK or lr == 0:
+                stream.write('\n'.join(chunk) + '\n')
+                stream.flush()
+                lr += len(chunk)
+                chunk = []
+        if chunk or lr == 0: # An empty resultset prints an empty line
+            stream.write('\n'.join(chunk) + '\n')
+            lr += len(chunk)
+        stream.flush()
+    finally:
+        rows.close() # Closes the reader, or stops the pool of --jobs
+    debug('(%i record%s found)', options.verbose, lr, 's' if lr > 1 else '')
 
 ## ============================================================================
 if __name__ == '__main__':
@@ -196,16 +725,56 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Query tool')
     parser.add_argument('-i', '--input', type=str, default='data', 
         metavar='DATASTORE', help='Datastore to use')
-    parser.add_argument('-s', '--select', type=str, required=True,
+    parser.add_argument('-s', '--select', type=str, default='',
         metavar='COLUMNS', help='columns to select')
     parser.add_argument('-o', '--order', type=str, default='',
-        metavar='COLUMNS', help='Order by columns')
+        metavar='COLUMNS', help='Order by columns, COLUMN:desc for descending order')
     parser.add_argument('-f', '--filter', type=str, default='',
-        metavar='CONDITIONS', help='Filter conditions')
+        metavar='CONDITIONS', help='Filter conditions, joined by AND (or a comma) and OR')
+    parser.add_argument('-g', '--group', type=str, default='',
+        metavar='COLUMNS', help='Group by columns')
+    parser.add_argument('-l', '--limit', type=int, default=0, metavar='N',
+        help='fetch only the first N rows')
+    parser.add_argument('--no_vectorize', action='store_true',
+        help='do not use numpy for the aggregates of numeric columns')
     parser.add_argument('--verbose', action='store_true', help='increase verbosity')
-    parser.add_argument('--show_plan', action='store_true', help='show query plan')
+    parser.add_argument('--show_plan', action='store_true',
+        help='explain the query plan, with estimated and actual rows and times')
+    parser.add_argument('--mmap', action='store_true', 
+        help='read the data file through a memory map')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+        help='read the selected rows with N processes')
+    parser.add_argument('--stats', action='store_true',
+        help='show counters and timers of the query in the error output')
+    parser.add_argument('--profile', type=str, metavar='FILE',
+        help='write a cProfile dump of the query to FILE')
+    parser.add_argument('--serve', type=str, metavar='ADDRESS',
+        help='answer queries over HTTP on HOST:PORT or on a Unix socket path')
+    parser.add_argument('--threads', type=int, default=4, metavar='N',
+        help='threads of the query server')
+    parser.add_argument('--cache_size', type=int, default=128, metavar='N',
+        help='results kept in the cache of the query server')
     args = parser.parse_args()
-    datastore = read_datastore(args)
-    plan = build_plan(datastore, args)
-    execute(plan, datastore, args)
-    output_resultset(datastore, plan, args)
+    if args.limit < 0:
+        parser.error('argument -l/--limit must not be negative')
+    if args.serve:
+        from server import serve
+        serve(args)
+        sys.exit(0)
+    if args.select == '':
+        parser.error('argument -s/--select is required')
+    if args.stats:
+        enable_metrics()
+    profiler = start_profile(args.profile)
+    try:
+        with timer('load'):
+            datastore = read_datastore(args)
+        with timer('plan'):
+            plan = build_plan(datastore, args)
+        with timer('execute'):
+            output_resultset(datastore, plan, execute(plan, datastore, args), args)
+    finally:
+        stop_profile(profiler, args.profile)
+    if args.show_plan:
+        plan['explain'].output()
+    output_metrics()
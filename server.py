@@ -0,0 +1,254 @@
+__all__ = ['ResultCache', 'QueryServer', 'serve']
+
+import os
+import sys
+import argparse
+import threading
+import traceback
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from util import *
+import query
+
+## ============================================================================
+# Query server. The datastore is loaded once and the queries are answered
+# over HTTP, on a TCP port or a Unix socket, with the output of query.py:
+#   GET /?select=STB,REV:sum&filter=DATE>2014-01-01&group=STB&order=&limit=
+# The results are cached by normalized query, until the .ds file changes
+## ----------------------------------------------------------------------------
+QUERY_PARAMETERS = ['select', 'filter', 'order', 'group', 'limit']
+
+## ============================================================================
+class ResultCache():
+    """ Least recently used cache of query results, shared by the threads
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, size):
+        """ :param size: Maximum number of results, 0 disables the cache
+        """
+        self.size = size
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def get(self, key):
+        """ :returns: The result of a query, None if it is not cached
+        """
+        with self.lock:
+            result = self.results.pop(key, None)
+            if result is not None:
+                self.results[key] = result # Most recently used
+            return result
+
+    # -------------------------------------------------------------------------
+    def put(self, key, result):
+        with self.lock:
+            if self.size == 0:
+                return
+            self.results.pop(key, None)
+            self.results[key] = result
+            if len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+    # -------------------------------------------------------------------------
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+## ============================================================================
+def normalize(options):
+    """ Builds the cache key of a query from its parsed terms, so equivalent
+        queries (like a different case, order of the filter conditions or
+        spelling of the values) share their result
+
+        :param options: The query options
+        :returns: A hashable key of the query
+    """
+    select = []
+    for term in options.select.split(','):
+        if term == '*':
+            select.extend([(c.name, '') for c in SCHEMA.columns])
+        else:
+            column, aggregate = query.parse_select_term(term, options)
+            select.append((column.name, aggregate))
+    filters = []
+    if options.filter != '':
+        for conditions in query.parse_filters(options.filter, options):
+            filters.append(tuple(sorted(set([(c.name, operator, tuple(values))
+                                             for c, operator, values in conditions]))))
+    order = [(c.name, desc) for c, desc in
+             [query.parse_order_term(t, options) for t in options.order.split(',')
+              if options.order != '']]
+    group = [column_by_name(name, fail=True).name
+             for name in options.group.split(',') if options.group != '']
+    return (tuple(select), tuple(sorted(set(filters))), tuple(order),
+            tuple(group), options.limit)
+
+## ============================================================================
+class QueryServer():
+    """ Runs the queries of the clients over a datastore loaded once. The
+        datastore is loaded again, and the cache cleared, when the
+        modification time of its .ds file changes. Loading it changes the
+        global schema, so it waits until no query is running
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, options):
+        """ :param options: Command line arguments, the defaults of every query
+        """
+        self.options = options
+        self.cache = ResultCache(options.cache_size)
+        self.condition = threading.Condition()
+        self.running = 0 # Queries using the loaded datastore
+        self.mtime = None
+        self.datastore = None
+
+    # -------------------------------------------------------------------------
+    def acquire_datastore(self):
+        """ Gets the datastore for a query, loading it again if it changed,
+            once the running queries are done. Release it with
+            release_datastore when the query is done
+
+            :returns: The loaded datastore and the modification time of its
+                      .ds file when it was loaded
+        """
+        mtime = os.stat('%s.ds' % self.options.input).st_mtime
+        with self.condition:
+            while mtime != self.mtime and self.running > 0:
+                self.condition.wait()
+            if mtime != self.mtime:
+                debug('loading datastore %s', self.options.verbose, self.options.input)
+                self.datastore = query.read_datastore(self.options)
+                self.mtime = mtime
+                self.cache.clear()
+            self.running += 1
+            return self.datastore, self.mtime
+
+    # -------------------------------------------------------------------------
+    def release_datastore(self):
+        with self.condition:
+            self.running -= 1
+            if self.running == 0:
+                self.condition.notify_all()
+
+    # -------------------------------------------------------------------------
+    def run(self, parameters):
+        """ Runs a query
+
+            :param parameters: Dictionary with the query parameters
+            :returns: The output of the query
+        """
+        options = argparse.Namespace(**vars(self.options))
+        options.select = parameters.get('select', '')
+        options.filter = parameters.get('filter', '')
+        options.order = parameters.get('order', '')
+        options.group = parameters.get('group', '')
+        options.limit = int(parameters.get('limit') or 0)
+        if options.select == '':
+            error('The select parameter is required')
+        if options.limit < 0:
+            error('The limit parameter must not be negative')
+        datastore, mtime = self.acquire_datastore()
+        try:
+            # A result is only served for the datastore it was computed on
+            key = (mtime, normalize(options))
+            result = self.cache.get(key)
+            if result is not None:
+                debug('cached result for %s', options.verbose, key)
+                return result
+            plan = query.build_plan(datastore, options)
+            output = StringIO()
+            query.output_resultset(datastore, plan, query.execute(plan, datastore, options),
+                                   options, output)
+            result = output.getvalue()
+            self.cache.put(key, result)
+            return result
+        finally:
+            self.release_datastore()
+
+## ============================================================================
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers GET requests with the output of a query
+    """
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        parameters = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        unknown = set(parameters) - set(QUERY_PARAMETERS)
+        try:
+            if unknown:
+                error('Unknown query parameters: %s' % ', '.join(sorted(unknown)))
+            result, status = self.server.queries.run(parameters), 200
+        except SystemExit as e: # util.error, the query is not valid
+            result, status = '%s\n' % e.code, 400
+        except ValueError as e:
+            result, status = '%s\n' % e, 400
+        except Exception as e: # A failure of the server, it keeps serving
+            print >> sys.stderr, traceback.format_exc()
+            result, status = '%s\n' % e, 500
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/csv' if status == 200 else 'text/plain')
+        self.send_header('Content-Length', str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+    def log_message(self, format, *args):
+        # The client address of a Unix socket is empty
+        debug(format, self.server.queries.options.verbose, *args)
+
+## ----------------------------------------------------------------------------
+class PoolMixIn():
+    """ Handles every request in a thread of a fixed pool, like
+        SocketServer.ThreadingMixIn with a bound number of threads
+    """
+
+    def process_request(self, request, client_address):
+        self.pool.apply_async(self.process_request_thread, (request, client_address))
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+class TCPQueryServer(PoolMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+class UnixQueryServer(PoolMixIn, SocketServer.UnixStreamServer):
+    pass
+
+## ============================================================================
+def serve(options):
+    """ Answers queries until interrupted
+
+        :param options: Command line arguments. options.serve is HOST:PORT
+                        (or :PORT) for TCP, or the path of a Unix socket
+    """
+    host, _, port = options.serve.rpartition(':')
+    if port.isdigit():
+        server = TCPQueryServer((host or 'localhost', int(port)), QueryHandler)
+    else:
+        if os.path.exists(options.serve):
+            os.remove(options.serve) # Socket of a previous server
+        server = UnixQueryServer(options.serve, QueryHandler)
+    server.pool = ThreadPool(options.threads)
+    server.queries = QueryServer(options)
+    server.queries.acquire_datastore() # Fail early if it cannot be loaded
+    server.queries.release_datastore()
+    print >> sys.stderr, 'Serving %s on %s' % (options.input, options.serve)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.terminate()
+        if not port.isdigit():
+            os.remove(options.serve)
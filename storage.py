@@ -0,0 +1,458 @@
+__all__ = ['LAYOUTS', 'COMPRESSORS', 'ZONE_TYPES', 'ColumnarWriter',
+           'BlockWriter', 'BlockReader', 'read_column', 'read_dictionary',
+           'write_dictionaries', 'dictionary_columns', 'load_schema',
+           'open_reader', 'row_runs']
+
+from array import array
+from collections import OrderedDict
+from itertools import islice, izip
+import mmap
+import pickle
+import zlib
+from util import *
+from util import Char, Date, Money, Time
+from metrics import count as count_metric
+try:
+    import lzma
+except ImportError: # Not in the standard library of Python 2
+    lzma = None
+
+LAYOUTS = ['row', 'columnar', 'block']
+
+## ============================================================================
+# Binary encoding of every column type in the columnar layout. Char columns
+# are dictionary encoded, so the stored value is the id in the dictionary
+## ----------------------------------------------------------------------------
+TYPECODES = {Char: 'I', Date: 'i', Money: 'i', Time: 'i'}
+FLUSH_ROWS = 65536
+
+## ============================================================================
+def column_file(prefix, column):
+    """ :returns: The file holding the values of a column """
+    return '%s.%s' % (prefix, column.name)
+
+## ============================================================================
+def dictionary_file(prefix, name):
+    """ :returns: The file holding the dictionary of a Char column """
+    return '%s.%s.dict' % (prefix, name)
+
+## ============================================================================
+class ColumnarWriter():
+    """ Writes the imported rows in the columnar layout: one file per column,
+        with the values in their binary encoding. Char values arrive as the
+        ids of the schema dictionaries
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, prefix, columns):
+        """ :param prefix: Name of the datastore, used as file prefix
+            :param columns: Columns of the rows to write
+        """
+        self.prefix = prefix
+        self.columns = columns
+        self.files = [open(column_file(prefix, c), 'wb') for c in columns]
+        self.buffers = [array(TYPECODES[c.type]) for c in columns]
+        self.pending = 0
+
+    # -------------------------------------------------------------------------
+    def write_fields(self, fields):
+        """ Appends a row to the column files
+
+            :param fields: List of the values from the parser, encoded by
+                           Schema.encode
+        """
+        for field, column, buf in zip(fields, self.columns, self.buffers):
+            if column.type == Char:
+                buf.append(field)
+                continue
+            try:
+                buf.append(column.type(field).encode())
+            except ValueError:
+                error('Invalid value for column %s: %s' % (column.name, field))
+        self.pending += 1
+        if self.pending == FLUSH_ROWS:
+            self.flush()
+
+    # -------------------------------------------------------------------------
+    def flush(self):
+        """ Writes the buffered values to the column files
+        """
+        for data_file, buf in zip(self.files, self.buffers):
+            buf.tofile(data_file)
+            del buf[:]
+        self.pending = 0
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Flushes the pending values
+        """
+        self.flush()
+        for data_file in self.files:
+            data_file.close()
+
+## ============================================================================
+# Block layout: the fixed width rows are compressed in blocks of BLOCK_ROWS
+# rows, written one after the other in the data file. The directory of the
+# blocks, in <prefix>.blocks, keeps the position and size of every block and
+# the minimum and maximum (encoded) value of the zone columns in the block
+## ----------------------------------------------------------------------------
+BLOCK_ROWS = 4096
+BLOCK_CACHE = 8 # Decompressed blocks kept by a reader
+READ_WINDOW = 65536 # Rows out of row order that are fetched block by block
+COMPRESSORS = {'zlib': zlib}
+if lzma is not None:
+    COMPRESSORS['lzma'] = lzma
+ZONE_TYPES = [Date, Money, Time] # The columns of these types have zone maps
+
+## ============================================================================
+def blocks_file(prefix):
+    """ :returns: The file holding the block directory """
+    return '%s.blocks' % prefix
+
+## ============================================================================
+class BlockWriter():
+    """ Writes the imported rows in the block layout, keeping the zone map
+        of the block being written
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, prefix, compression='zlib'):
+        """ :param prefix: Name of the datastore, used as file prefix
+            :param compression: Name of the compression module
+        """
+        self.prefix = prefix
+        self.compression = compression
+        self.compress = COMPRESSORS[compression].compress
+        self.data_file = open(prefix, 'wb')
+        self.blocks = []
+        self.rows = []
+        self.zone_columns = [c for c in SCHEMA.columns if c.type in ZONE_TYPES]
+        # Encoded values of the zone columns, the same values repeat a lot
+        self.encoded = [{} for c in self.zone_columns]
+
+    # -------------------------------------------------------------------------
+    def write_row(self, text, fields):
+        """ Appends a row to the current block
+
+            :param text: The fixed width text of the row
+            :param fields: List of the raw values from the parser
+        """
+        self.rows.append(text)
+        if len(self.rows) == BLOCK_ROWS:
+            self.flush()
+
+    # -------------------------------------------------------------------------
+    def flush(self):
+        """ Computes the zone map of the current block, then compresses and
+            writes the block
+        """
+        if not self.rows:
+            return
+        zones = {}
+        for column, encoded in zip(self.zone_columns, self.encoded):
+            begin, end = column.offset, column.offset + column.size
+            values = []
+            for field in set([row[begin:end] for row in self.rows]):
+                value = encoded.get(field)
+                if value is None:
+                    try:
+                        value = encoded[field] = column.type(field.strip()).encode()
+                    except ValueError:
+                        error('Invalid value for column %s: %s' % (column.name, field))
+                values.append(value)
+            zones[column.name] = (min(values), max(values))
+            if len(encoded) > 65536:
+                encoded.clear()
+        data = self.compress(''.join(self.rows))
+        self.blocks.append((self.data_file.tell(), len(data), len(self.rows), zones))
+        self.data_file.write(data)
+        self.rows = []
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Writes the last block and the block directory
+        """
+        self.flush()
+        self.data_file.close()
+        directory = {'compression': self.compression, 'block_rows': BLOCK_ROWS,
+                     'blocks': self.blocks}
+        with open(blocks_file(self.prefix), 'wb') as blocks_data:
+            pickle.dump(directory, blocks_data, pickle.HIGHEST_PROTOCOL)
+
+## ============================================================================
+def read_column(prefix, column, num_rows):
+    """ Reads the values of a column in the columnar layout
+
+        :param prefix: Name of the datastore
+        :param column: The column to read
+        :param num_rows: Number of rows in the datastore
+        :returns: An array with the encoded values of the column
+    """
+    values = array(TYPECODES[column.type])
+    with open(column_file(prefix, column), 'rb') as data_file:
+        values.fromfile(data_file, num_rows)
+    return values
+
+## ============================================================================
+def read_dictionary(prefix, name):
+    """ Reads the dictionary of a dictionary encoded Char column
+
+        :param prefix: Name of the datastore
+        :param name: Name of the column
+        :returns: A list with the value of every dictionary id
+    """
+    with open(dictionary_file(prefix, name), 'rb') as dict_file:
+        return pickle.load(dict_file)
+
+## ============================================================================
+def write_dictionaries(prefix):
+    """ Saves the dictionaries of the encoded columns of the schema
+
+        :param prefix: Name of the datastore
+    """
+    for name, dictionary in SCHEMA.dictionaries.iteritems():
+        with open(dictionary_file(prefix, name), 'wb') as dict_file:
+            pickle.dump(dictionary.values, dict_file, pickle.HIGHEST_PROTOCOL)
+
+## ============================================================================
+def dictionary_columns(datastore):
+    """ :returns: The names of the dictionary encoded columns of a datastore.
+                  The Char columns of the columnar layout always are, the
+                  other layouts before dictionaries had none
+    """
+    if 'encoded' in datastore:
+        return datastore['encoded']
+    if datastore.get('layout', 'row') != 'columnar':
+        return []
+    return [name for name, type_name, _, _ in datastore['schema'] if type_name == 'char']
+
+## ============================================================================
+def load_schema(datastore):
+    """ Loads the schema of a datastore, with the saved dictionaries of its
+        encoded columns
+    """
+    SCHEMA.load(datastore['schema'], {name: read_dictionary(datastore['datafile'], name)
+                                      for name in dictionary_columns(datastore)})
+
+## ============================================================================
+# Readers of the datastore layouts. read() yields the selected columns of
+# each row as objects of the column types, in the order of the given rows
+## ============================================================================
+def row_runs(rows, max_run=4096):
+    """ Groups the rows to fetch in runs of contiguous row ids, keeping the
+        order given by the plan
+
+        :param rows: The row ids to fetch, in the plan order
+        :param max_run: Maximum number of rows in a single run
+        :returns: A generator of (first_row, num_rows) tuples
+    """
+    first, count = None, 0
+    for row in rows:
+        if count and row == first + count and count < max_run:
+            count += 1
+            continue
+        if count:
+            yield first, count
+        first, count = row, 1
+    if count:
+        yield first, count
+
+## ----------------------------------------------------------------------------
+class SeekReader():
+    """ Reads the row layout with one seek and read per field
+    """
+
+    def __init__(self, datastore):
+        self.datafile = open(datastore['datafile'], 'r')
+
+    def read(self, rows, columns):
+        num_rows, row_size = 0, SCHEMA.row_size
+        parsers = [SCHEMA.parser(c) for c in columns]
+        try:
+            for row in rows:
+                # Get the start position of the current selected row
+                line_begin = row * row_size
+                values = []
+                for column, parse in zip(columns, parsers):
+                    # Read the data according to the field size
+                    self.datafile.seek(line_begin + column.offset)
+                    values.append(parse(self.datafile.read(column.size)))
+                num_rows += 1
+                yield row, values
+        finally:
+            count_metric('seeks', num_rows * len(columns))
+            count_metric('bytes read', num_rows * sum([c.size for c in columns]))
+
+    def close(self):
+        self.datafile.close()
+
+## ----------------------------------------------------------------------------
+class MmapReader():
+    """ Reads the row layout from a memory map of the data file. The rows are
+        decoded in place from the map, in runs of contiguous ids, so a full
+        scan does not need a system call per field nor a copy of the rows
+    """
+
+    def __init__(self, datastore):
+        self.datafile = open(datastore['datafile'], 'rb')
+        self.data = None
+        if datastore['num_rows'] > 0: # An empty file cannot be mapped
+            self.data = mmap.mmap(self.datafile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, rows, columns):
+        decode, row_size = SCHEMA.codec(columns).decode, SCHEMA.row_size
+        data, num_runs, num_bytes = self.data, 0, 0
+        try:
+            for first, num_rows in row_runs(rows):
+                num_runs += 1
+                num_bytes += num_rows * row_size
+                for row in xrange(first, first + num_rows):
+                    yield row, decode(data, row * row_size)
+        finally:
+            count_metric('mapped runs', num_runs)
+            count_metric('bytes read', num_bytes)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.datafile.close()
+
+## ----------------------------------------------------------------------------
+class ColumnarReader():
+    """ Reads the columnar layout. Only the files of the requested columns
+        are loaded, Char ids are decoded to the interned values of the
+        column dictionary
+    """
+
+    def __init__(self, datastore):
+        self.prefix = datastore['datafile']
+        self.num_rows = datastore['num_rows']
+        self.loaded = {}
+
+    def load(self, column):
+        if column.name not in self.loaded:
+            values = read_column(self.prefix, column, self.num_rows)
+            count_metric('columns loaded')
+            count_metric('bytes read', values.itemsize * len(values))
+            self.loaded[column.name] = values
+        return self.loaded[column.name]
+
+    def read(self, rows, columns):
+        fields = [(SCHEMA.dictionaries[c.name].interned.__getitem__ if c.type == Char
+                   else c.type.decode, self.load(c)) for c in columns]
+        for row in rows:
+            yield row, [decode(column_values[row]) for decode, column_values in fields]
+
+    def close(self):
+        self.loaded = {}
+
+## ----------------------------------------------------------------------------
+class BlockReader():
+    """ Reads the block layout. The last used blocks are kept decompressed,
+        so rows read in row order decompress every block once. Rows in
+        another order (like the order of an index) are fetched in windows
+        of READ_WINDOW rows, sorted by row, so every block is decompressed
+        once per window
+    """
+
+    def __init__(self, datastore):
+        with open(blocks_file(datastore['datafile']), 'rb') as blocks_data:
+            directory = pickle.load(blocks_data)
+        self.decompress = COMPRESSORS[directory['compression']].decompress
+        self.block_rows = directory['block_rows']
+        self.blocks = directory['blocks']
+        self.datafile = open(datastore['datafile'], 'rb')
+        self.cache = OrderedDict()
+
+    def block(self, number):
+        """ :returns: The text of the rows of a block
+        """
+        text = self.cache.pop(number, None)
+        if text is None:
+            offset, size, _, _ = self.blocks[number]
+            self.datafile.seek(offset)
+            text = self.decompress(self.datafile.read(size))
+            count_metric('blocks decompressed')
+            count_metric('bytes read', size)
+            if len(self.cache) == BLOCK_CACHE:
+                self.cache.popitem(last=False)
+        self.cache[number] = text
+        return text
+
+    def read(self, rows, columns):
+        decode, row_size = SCHEMA.codec(columns).decode, SCHEMA.row_size
+        rows = iter(rows)
+        current, text = None, None
+        while True:
+            window = list(islice(rows, READ_WINDOW))
+            if not window:
+                break
+            if all([a < b for a, b in izip(window, islice(window, 1, None))]):
+                for row in window:
+                    number, line_begin = divmod(row, self.block_rows)
+                    if number != current:
+                        current, text = number, self.block(number)
+                    yield row, decode(text, line_begin * row_size)
+                continue
+            values = [None] * len(window)
+            for slot in sorted(xrange(len(window)), key=window.__getitem__):
+                number, line_begin = divmod(window[slot], self.block_rows)
+                if number != current:
+                    current, text = number, self.block(number)
+                values[slot] = decode(text, line_begin * row_size)
+            for row, row_values in izip(window, values):
+                yield row, row_values
+
+    def zone_rows(self, column, bounds, max_scan):
+        """ Finds the rows with a value of a zone column in a range. The
+            blocks out of the range are skipped and the blocks inside it are
+            taken whole, only the blocks across a bound of the range are read
+
+            :param column: A zone column
+            :param bounds: Tuple with the low and high encoded values (None
+                           for no bound) and if they are included
+            :param max_scan: Maximum number of rows to read
+            :returns: A sorted list with the rows, None if more than max_scan
+                      rows would be read
+        """
+        low, high, low_inclusive, high_inclusive = bounds
+        def above_low(value):
+            return low is None or value > low or (low_inclusive and value == low)
+        def below_high(value):
+            return high is None or value < high or (high_inclusive and value == high)
+        selected = []
+        for number, (_, _, num_rows, zones) in enumerate(self.blocks):
+            minimum, maximum = zones[column.name]
+            if not above_low(maximum) or not below_high(minimum):
+                continue
+            inside = above_low(minimum) and below_high(maximum)
+            selected.append((number, num_rows, inside))
+        if sum([n for _, n, inside in selected if not inside]) > max_scan:
+            return None
+        rows = []
+        for number, num_rows, inside in selected:
+            first = number * self.block_rows
+            if inside:
+                rows.extend(xrange(first, first + num_rows))
+                continue
+            for row, (value,) in self.read(xrange(first, first + num_rows), [column]):
+                value = value.encode()
+                if above_low(value) and below_high(value):
+                    rows.append(row)
+        return rows
+
+    def close(self):
+        self.cache.clear()
+        self.datafile.close()
+
+## ============================================================================
+def open_reader(datastore, options):
+    """ :returns: The reader for the layout of the datastore
+    """
+    if datastore['layout'] == 'columnar':
+        return ColumnarReader(datastore)
+    if datastore['layout'] == 'block':
+        return BlockReader(datastore)
+    if options.mmap:
+        return MmapReader(datastore)
+    return SeekReader(datastore)
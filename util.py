@@ -1,18 +1,32 @@
 
-__all__ = ['STB', 'TITLE', 'PROVIDER', 'DATE', 'REV', 'VIEW_TIME', 
-           'COLUMNS', 'column_by_name', 'error', 'ROW_SIZE',
-           'debug', 'column_by_position', 'SelectColumn']
+__all__ = ['SCHEMA', 'DEFAULT_DEFINITIONS', 'Schema', 'Dictionary', 'read_schema',
+           'column_by_name', 'error', 'debug', 'SelectColumn']
 
 from datetime import datetime as dt
 from collections import namedtuple
+import struct
 import sys
 
 ## ============================================================================
 # Classes for parsing and formatting the column values from the datastore
 # __init__: Parses raw data from data file to the column value
 # format: Converts column value to the output format
+# encode / decode: Converts the column value to and from the scalar used
+#                  by the binary layouts of the datastore
 ## ============================================================================
-class Char():
+class Value(object):
+
+    def encode(self):
+        return self.value
+
+    @classmethod
+    def decode(cls, value):
+        instance = cls.__new__(cls)
+        instance.value = value
+        return instance
+
+## ----------------------------------------------------------------------------
+class Char(Value):
 
     def __init__(self, value):
         self.value = value
@@ -21,7 +35,7 @@ class Char():
         return self.value
 
 ## ----------------------------------------------------------------------------
-class Date():
+class Date(Value):
 
     def __init__(self, value):
         self.value = dt.strptime(value, '%Y-%m-%d')
@@ -29,43 +43,260 @@ class Date():
     def format(self):
         return self.value.strftime('%Y-%m-%d')
 
+    def encode(self):
+        return self.value.toordinal()
+
+    @classmethod
+    def decode(cls, value):
+        return super(Date, cls).decode(dt.fromordinal(value))
+
 ## ----------------------------------------------------------------------------
-class Money():
+class Money(Value):
 
     def __init__(self, value):
         dollars, cents = tuple(value.split('.'))
-        self.value = (int(dollars) * 100) + int(cents)
+        self.value = (abs(int(dollars)) * 100) + int(cents)
+        if dollars.startswith('-'): # -0.50 is negative too
+            self.value = -self.value
 
     def format(self):
-        return '%.2f' % (self.value / 100)
+        dollars, cents = divmod(abs(self.value), 100)
+        return '%s%i.%02i' % ('-' if self.value < 0 else '', dollars, cents)
 
 ## ----------------------------------------------------------------------------
-class Time():
+class Time(Value):
 
     def __init__(self, value):
         hours, minutes = tuple(value.split(':'))
-        self.value = (int(hours) * 60) + int(minutes)
+        self.value = (abs(int(hours)) * 60) + int(minutes)
+        if hours.startswith('-'):
+            self.value = -self.value
 
     def format(self):
-        return '%i:%02i' % (self.value / 60, self.value % 60)
+        hours, minutes = divmod(abs(self.value), 60)
+        return '%s%i:%02i' % ('-' if self.value < 0 else '', hours, minutes)
 
 
 ## ============================================================================
 Column = namedtuple('Column', 'name index is_index size offset type')
-# Current schema of the data file. Further work can be parsing the table
-# definition from a SQL CREATE TABLE syntax or something similar
+# Schema of the data file. A datastore keeps the definitions of its columns
+# in the .ds file, as (name, type, size, is indexed) tuples. Other feeds are
+# imported with a definition file, one column per line:
+#   NAME TYPE SIZE [noindex]
+# where TYPE is char, date, money or time. Lines starting with # are comments
 ## ----------------------------------------------------------------------------
-STB = Column(name='STB', index=0, is_index=True, size=64, offset=0, type=Char)
-TITLE = Column(name='TITLE', index=1, is_index=True, size=64, offset=64, type=Char)
-PROVIDER = Column(name='PROVIDER', index=2, is_index=True, size=64, offset=128, type=Char)
-DATE = Column(name='DATE', index=3, is_index=True, size=10, offset=192, type=Date)
-REV = Column(name='REV', index=4, is_index=True, size=10, offset=202, type=Money)
-VIEW_TIME = Column(name='VIEW_TIME', index=5, is_index=True, size=10, offset=212, type=Time)
-COLUMNS = [STB, TITLE, PROVIDER, DATE, REV, VIEW_TIME]
-ROW_SIZE = sum([c.size for c in COLUMNS])
+TYPES = {'char': Char, 'date': Date, 'money': Money, 'time': Time}
+DEFAULT_DEFINITIONS = [('STB', 'char', 64, True), ('TITLE', 'char', 64, True),
+                       ('PROVIDER', 'char', 64, True), ('DATE', 'date', 10, True),
+                       ('REV', 'money', 10, True), ('VIEW_TIME', 'time', 10, True)]
 
+ID = struct.Struct('<I') # Id of a value in the dictionary of a Char column
 AGGREGATES = 'min,max,sum,count,collect,'.split(',')
-COLUMN_PROPERTIES = 'name index is_index size offset'.split()
+
+## ============================================================================
+def read_schema(path):
+    """ Reads a schema definition file
+
+        :param path: The definition file
+        :returns: The list of column definitions
+    """
+    definitions = []
+    try:
+        with open(path, 'r') as schema_file:
+            lines = schema_file.readlines()
+    except IOError as e:
+        error('Unable to read schema: %s' % e)
+    for line in lines:
+        terms = line.split()
+        if not terms or terms[0].startswith('#'):
+            continue
+        if len(terms) not in [3, 4] or not terms[2].isdigit() or \
+           (len(terms) == 4 and terms[3] != 'noindex'):
+            error('Invalid column definition: %s' % line.strip())
+        definitions.append((terms[0].upper(), terms[1].lower(), int(terms[2]),
+                            len(terms) == 3))
+    return definitions
+
+## ============================================================================
+class Dictionary():
+    """ The values of a dictionary encoded Char column, by id in order of
+        appearance. Each value is interned in a single Char object, shared
+        by every row that reads it
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, values=()):
+        """ :param values: The value of every id, as saved in the datastore
+        """
+        self.values = list(values)
+        self.ids = dict(zip(self.values, xrange(len(self.values))))
+        self.packed = [ID.pack(value_id) for value_id in xrange(len(self.values))]
+        self.interned = [Char.decode(value) for value in self.values]
+
+    # -------------------------------------------------------------------------
+    def id(self, value):
+        """ :returns: The id of a value, added to the dictionary if it is new
+        """
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+            self.packed.append(ID.pack(value_id))
+            self.interned.append(Char.decode(value))
+        return value_id
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.values)
+
+## ============================================================================
+class RowCodec():
+    """ Decodes some columns of the fixed width rows with a struct format
+        compiled for them, which reads every field of a row in one call and
+        skips the other columns. Dictionary encoded columns are read as
+        integer ids and decoded to their interned value
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, columns, dictionaries):
+        """ :param columns: The columns to decode, in the order of the values
+            :param dictionaries: The Dictionary of every encoded column
+        """
+        # A column may be read more than once, like a group column
+        ordered = sorted(dict([(c.name, c) for c in columns]).values(),
+                         key=lambda c: c.offset)
+        names = [c.name for c in ordered]
+        layout, position = ['<'], 0
+        for column in ordered:
+            if column.offset > position:
+                layout.append('%ix' % (column.offset - position))
+            layout.append('I' if column.name in dictionaries else '%is' % column.size)
+            position = column.offset + column.size
+        self.struct = struct.Struct(''.join(layout))
+        self.slots = [(names.index(c.name), c.name not in dictionaries) for c in columns]
+        self.fields = [(c.type if c.name not in dictionaries else
+                        dictionaries[c.name].interned.__getitem__,
+                        names.index(c.name), c.name not in dictionaries) for c in columns]
+
+    # -------------------------------------------------------------------------
+    def split(self, data, offset=0):
+        """ :returns: The stripped text of the columns in the row at offset,
+                      the id for the dictionary encoded columns
+        """
+        raw = self.struct.unpack_from(data, offset)
+        return [raw[slot].strip() if text else raw[slot] for slot, text in self.slots]
+
+    # -------------------------------------------------------------------------
+    def decode(self, data, offset=0):
+        """ :returns: The values of the columns in the row at offset
+        """
+        raw = self.struct.unpack_from(data, offset)
+        return [parse(raw[slot].strip() if text else raw[slot])
+                for parse, slot, text in self.fields]
+
+## ============================================================================
+class Schema():
+    """ The columns of the datastore, compiled for the fixed width rows: the
+        offsets of the columns, a format string to write a row and the row
+        codecs of the column sets that are read. Char columns with a
+        dictionary are stored as the id of their value
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, definitions=DEFAULT_DEFINITIONS):
+        self.load(definitions)
+
+    # -------------------------------------------------------------------------
+    def load(self, definitions, dictionaries={}):
+        """ Compiles the schema of a datastore
+
+            :param definitions: List of (name, type, size, is indexed) tuples
+            :param dictionaries: Dictionary with the value of every id of the
+                                 dictionary encoded columns
+        """
+        columns, offset = [], 0
+        for position, (name, type_name, size, is_index) in enumerate(definitions):
+            if type_name not in TYPES:
+                error('Unknown type %s of column %s' % (type_name, name))
+            if size <= 0:
+                error('Invalid size of column %s: %i' % (name, size))
+            if name in dictionaries and type_name != 'char':
+                error('Only char columns are dictionary encoded, not %s' % name)
+            columns.append(Column(name=name, index=position, is_index=is_index,
+                                  size=ID.size if name in dictionaries else size,
+                                  offset=offset, type=TYPES[type_name]))
+            offset += columns[-1].size
+        if not columns:
+            error('The schema has no columns')
+        self.definitions = [tuple(d) for d in definitions]
+        self.columns = columns
+        self.by_name = {c.name: c for c in columns}
+        if len(self.by_name) != len(columns):
+            error('Repeated column names in the schema')
+        self.dictionaries = {name: Dictionary(values)
+                             for name, values in dictionaries.iteritems()}
+        self.encoded = [(c, definition[2], self.dictionaries[c.name])
+                        for c, definition in zip(columns, self.definitions)
+                        if c.name in self.dictionaries]
+        self.encoders = [(c.index, size, d) for c, size, d in self.encoded]
+        self.row_size = offset
+        self.row_format = ''.join(['%s' if c.name in self.dictionaries else
+                                   '%%-%i.%is' % (c.size, c.size) for c in columns])
+        self.codecs = {}
+
+    # -------------------------------------------------------------------------
+    def codec(self, columns):
+        """ :returns: The row codec of some columns, compiled once
+        """
+        key = tuple([c.name for c in columns])
+        if key not in self.codecs:
+            self.codecs[key] = RowCodec(columns, self.dictionaries)
+        return self.codecs[key]
+
+    # -------------------------------------------------------------------------
+    def parser(self, column):
+        """ :returns: A function from the stored text of a column to its value
+        """
+        dictionary = self.dictionaries.get(column.name)
+        if dictionary is None:
+            return lambda text: column.type(text.strip())
+        return lambda text: dictionary.interned[ID.unpack(text)[0]]
+
+    # -------------------------------------------------------------------------
+    def encode(self, fields):
+        """ Replaces the values of the dictionary encoded columns by their ids
+
+            :param fields: The raw values of every column, updated in place
+            :returns: The fields
+        """
+        for index, size, dictionary in self.encoders:
+            value = fields[index][:size].strip()
+            try:
+                fields[index] = dictionary.ids[value]
+            except KeyError:
+                fields[index] = dictionary.id(value)
+        return fields
+
+    # -------------------------------------------------------------------------
+    def format_row(self, fields):
+        """ :param fields: The values of every column, encoded by encode()
+            :returns: The fixed width text of a row, the values are padded or
+                      cut to the size of their column
+        """
+        if self.encoders:
+            fields = list(fields)
+            for index, _, dictionary in self.encoders:
+                fields[index] = dictionary.packed[fields[index]]
+        return self.row_format % tuple(fields)
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        return 'Schema(%s)' % ', '.join(['%s %s(%i)' % (c.name, c.type.__name__, c.size)
+                                        for c in self.columns])
+
+## ----------------------------------------------------------------------------
+# Schema of the current datastore, loaded from its .ds file
+SCHEMA = Schema()
 
 ## ============================================================================
 class SelectColumn(): ## TODO: Cambiar de lugar esta clase
@@ -96,7 +327,7 @@ class SelectColumn(): ## TODO: Cambiar de lugar esta clase
 
             :returns: A property from the column namedtuple
         """
-        return self.column[COLUMN_PROPERTIES.index(attr)]
+        return getattr(self.column, attr)
 
     # -------------------------------------------------------------------------
     def add_value(self, value):
@@ -106,7 +337,15 @@ class SelectColumn(): ## TODO: Cambiar de lugar esta clase
 
             :param value: Raw value from the datastore
         """
-        new_value = self.column.type(value)
+        self.add_parsed(self.column.type(value))
+
+    # -------------------------------------------------------------------------
+    def add_parsed(self, new_value):
+        """ Same as add_value, for a value already built with the column type,
+            as read from the binary layouts
+
+            :param new_value: Value object of the column type
+        """
         if self.aggregate == '':
             self.current_value.append(new_value)
         elif self.aggregate in ['min', 'max', 'sum'] and not self.current_value:
@@ -131,6 +370,51 @@ class SelectColumn(): ## TODO: Cambiar de lugar esta clase
                     self.raw_values.add(new_value.value)
                     self.current_value.append(new_value)
 
+    # -------------------------------------------------------------------------
+    def partial(self):
+        """ :returns: The current value with the values encoded, to send a
+                      partial aggregate between processes
+        """
+        if self.current_value is None or self.aggregate == 'count':
+            return self.current_value
+        if self.aggregate in ['', 'collect']:
+            return [v.encode() for v in self.current_value]
+        return self.current_value.encode()
+
+    # -------------------------------------------------------------------------
+    def merge(self, partial):
+        """ Adds the aggregate of a select column of the same column and
+            aggregate over later rows, like a partition of the parallel
+            execution
+
+            :param partial: The partial aggregate of the other select column
+        """
+        if partial is None: # No rows
+            return
+        decode = self.column.type.decode
+        if self.aggregate == '':
+            self.current_value.extend([decode(v) for v in partial])
+        elif self.aggregate == 'count':
+            self.current_value = (self.current_value or 0) + partial
+        elif self.aggregate == 'collect':
+            for value in partial:
+                self.add_parsed(decode(value))
+        else:
+            self.add_parsed(decode(partial))
+
+    # -------------------------------------------------------------------------
+    def set_result(self, value):
+        """ Sets an aggregate computed out of add_value, like in the
+            vectorized engine
+
+            :param value: The number of rows for count, the encoded value
+                          for min, max and sum
+        """
+        if self.aggregate == 'count':
+            self.current_value = value
+        else:
+            self.current_value = self.column.type.decode(value)
+
     # -------------------------------------------------------------------------
     def values(self):
         """ Get the values of the current column
@@ -140,11 +424,13 @@ class SelectColumn(): ## TODO: Cambiar de lugar esta clase
         if self.aggregate == '':
             return [v.format() for v in self.current_value]
         if self.aggregate in ['min', 'max', 'sum']:
+            if self.current_value is None: # No rows were selected
+                return ['']
             return [self.current_value.format()]
         if self.aggregate == 'count':
-            return ['%i' % self.current_value]
+            return ['%i' % (self.current_value or 0)]
         if self.aggregate == 'collect':
-            return ['[%s]' % ','.join([v.format() for v in self.current_value])]
+            return ['[%s]' % ','.join([v.format() for v in self.current_value or []])]
 
     # -------------------------------------------------------------------------
     def format_name(self):
@@ -168,42 +454,30 @@ class SelectColumn(): ## TODO: Cambiar de lugar esta clase
 
 ## ============================================================================
 def column_by_name(column_name, fail=False):
-    """ Finds a column for the given column name
+    """ Finds a column of the current schema for the given column name
 
         :param column_name: The name of the column to find
         :param fail: calls error if no column is found
         :returns: The column with the given name, empty if not found
     """
-    for column in COLUMNS:
-        if column_name.upper() == column.name:
-            return column
-    if fail: error('Unknown column [%s]' % column_name)
-    return False
-
-## ============================================================================
-def column_by_position(index, fail=False):
-    """ Finds a column for the given position
-
-        :param index: The index of the column to find
-        :param fail: calls error if no column is found
-        :returns: The column with the given index, empty if not found
-    """
-    for column in COLUMNS:
-        if index == column.index:
-            return column
-    if fail: error('Unknown column index [%i]' % index)
-    return False
+    column = SCHEMA.by_name.get(column_name.upper())
+    if column is None:
+        if fail: error('Unknown column [%s]' % column_name)
+        return False
+    return column
 
 ## ============================================================================
-def debug(message, is_verbose):
-    """ Prints a debug message in the error output
+def debug(message, is_verbose, *args):
+    """ Prints a debug message in the error output. The message is only
+        formatted with the arguments when it is printed, hot loops should
+        also check is_verbose before the call
     """
     if is_verbose:
-        print >> sys.stderr, 'DEBUG: %s' % message
+        print >> sys.stderr, 'DEBUG: %s' % (message % args if args else message)
 
 ## ============================================================================
 def error(message):
-    """Prints an error message in the error output and exits
+    """Prints an error message in the error output and exits. The message
+       is kept in the SystemExit exception, for the query server
     """
-    print >> sys.stderr, message
-    sys.exit(1)
+    sys.exit(message)
@@ -0,0 +1,277 @@
+__all__ = ['can_scan', 'can_vectorize', 'execute_vectorized', 'scan_ranks']
+
+from util import *
+from util import Date, Money, Time
+from storage import BlockReader, column_file
+from index import MergedIndex
+try:
+    import numpy
+except ImportError: # The object engine is used without numpy
+    numpy = None
+
+## ============================================================================
+# Vectorized engine for the aggregates of numeric columns. The selected
+# values of each column are read in a single NumPy integer array, with the
+# encoding of util.Value.encode, and reduced with array operations. Groups
+# are coded with the rank files of the group indexes
+## ----------------------------------------------------------------------------
+NUMERIC = [Date, Money, Time]
+VECTOR_AGGREGATES = ['min', 'max', 'sum', 'count']
+EPOCH_ORDINAL = 719163 # Day number of 1970-01-01, the numpy date epoch
+SCALES = {Money: ('.', 100), Time: (':', 60)}
+
+## ============================================================================
+def can_scan(options):
+    """ :returns: True if the rank files can be scanned with numpy
+    """
+    return numpy is not None and not options.no_vectorize
+
+## ============================================================================
+def can_vectorize(plan, datastore, options):
+    """ Checks if the plan can run in the vectorized engine: numpy is
+        available, every column is a numeric aggregate (or a count, or a
+        group column) and the group columns are indexed
+
+        :param plan: Dictionary with the requested query
+        :param datastore: Current datastore
+        :param options: Command line arguments
+        :returns: True if the vectorized engine can run the plan
+    """
+    if numpy is None or options.no_vectorize or datastore['num_rows'] == 0:
+        return False
+    for column in plan['columns']:
+        if column.aggregate == '':
+            if column.column not in plan['group_by']:
+                return False
+        elif column.aggregate not in VECTOR_AGGREGATES:
+            return False
+        elif column.aggregate != 'count' and column.type not in NUMERIC:
+            return False
+    if not all([c.name in datastore['indexes'] for c in plan['group_by']]):
+        return False
+    # The group codes combine the key positions in a 64 bits integer
+    num_codes = 1
+    for column in plan['group_by']:
+        num_codes *= max(len(datastore['indexes'][column.name]), 1)
+    return num_codes < 2 ** 62
+
+## ============================================================================
+def parse_text(field, column):
+    """ Converts the fixed width text of a column to its integer encoding.
+        Money and Time values are parsed one character position at a time
+        for all the rows, as the digits before and after the separator and
+        the minus sign
+
+        :param field: Byte matrix with the text of the column in each row
+        :param column: The column of the values
+        :returns: An integer array with the encoded values
+    """
+    if column.type == Date:
+        field = field[:, :10] # YYYY-MM-DD, a wider column is padded
+        raw = numpy.ascontiguousarray(field).view('S%i' % field.shape[1]).ravel()
+        return raw.astype('datetime64[D]').astype(numpy.int64) + EPOCH_ORDINAL
+    separator, scale = SCALES[column.type]
+    major = numpy.zeros(len(field), dtype=numpy.int64)
+    minor = numpy.zeros(len(field), dtype=numpy.int64)
+    after = numpy.zeros(len(field), dtype=bool)
+    negative = numpy.zeros(len(field), dtype=bool)
+    for position in range(column.size):
+        char = field[:, position].astype(numpy.int64)
+        digit = (char >= ord('0')) & (char <= ord('9'))
+        major = numpy.where(digit & ~after, major * 10 + char - ord('0'), major)
+        minor = numpy.where(digit & after, minor * 10 + char - ord('0'), minor)
+        after |= char == ord(separator)
+        negative |= char == ord('-')
+    values = major * scale + minor
+    return numpy.where(negative, -values, values)
+
+## ============================================================================
+def read_values(datastore, column, rows):
+    """ Reads the encoded values of a column for the selected rows
+
+        :param datastore: Current datastore
+        :param column: The numeric column to read
+        :param rows: Array with the selected rows, None for all the rows
+        :returns: An integer array with the values
+    """
+    if datastore['layout'] == 'columnar':
+        values = numpy.fromfile(column_file(datastore['datafile'], column),
+                                dtype=numpy.int32).astype(numpy.int64)
+        return values if rows is None else values[rows]
+    if datastore['layout'] == 'block':
+        return read_block_values(datastore, column, rows)
+    data = numpy.memmap(datastore['datafile'], dtype=numpy.uint8, mode='r',
+                        shape=(datastore['num_rows'], SCHEMA.row_size))
+    field = data[:, column.offset:column.offset + column.size]
+    if rows is not None:
+        field = field[rows]
+    return parse_text(field, column)
+
+## ============================================================================
+def read_block_values(datastore, column, rows):
+    """ Reads the encoded values of a column in the block layout. The blocks
+        of the selected rows are decompressed and parsed one at a time, so
+        only one block is held uncompressed
+
+        :param datastore: Current datastore
+        :param column: The numeric column to read
+        :param rows: Array with the selected rows, None for all the rows
+        :returns: An integer array with the values, in the order of the rows
+    """
+    reader = BlockReader(datastore)
+    block_rows = reader.block_rows
+    if rows is None:
+        numbers, order = xrange(len(reader.blocks)), None
+    else:
+        order = numpy.argsort(rows, kind='mergesort')
+        rows = rows[order]
+        numbers = numpy.unique(rows // block_rows)
+    parts = []
+    for number in numbers:
+        data = numpy.frombuffer(reader.block(number), dtype=numpy.uint8)
+        field = data.reshape(-1, SCHEMA.row_size)[:, column.offset:column.offset + column.size]
+        if rows is not None:
+            first = number * block_rows
+            begin, end = numpy.searchsorted(rows, [first, first + block_rows])
+            field = field[rows[begin:end] - first]
+        parts.append(parse_text(field, column))
+    reader.close()
+    values = numpy.concatenate(parts) if parts else numpy.zeros(0, dtype=numpy.int64)
+    if order is None:
+        return values
+    result = numpy.empty_like(values)
+    result[order] = values
+    return result
+
+## ============================================================================
+def read_ranks(index, num_rows):
+    """ :returns: An integer array with the rank of every row in an index,
+                  mapping the ranks of the delta indexes to the merged keys.
+                  The ranks of a rewritten row come from the newest delta
+    """
+    if not isinstance(index, MergedIndex):
+        return numpy.fromfile(index.rank_path, dtype=numpy.uint32).astype(numpy.int64)
+    ranks = numpy.zeros(num_rows, dtype=numpy.int64)
+    for part, positions in zip(index.parts, index.positions):
+        part_ranks = numpy.asarray(positions, dtype=numpy.int64)[
+            numpy.fromfile(part.rank_path, dtype=numpy.uint32)]
+        if part.rows_path is None:
+            ranks[part.first_row:part.first_row + len(part_ranks)] = part_ranks
+        else:
+            ranks[numpy.fromfile(part.rows_path, dtype=numpy.uint32)] = part_ranks
+    return ranks
+
+## ============================================================================
+def scan_ranks(index, num_rows, begin, end):
+    """ Scans the rank file of an index for the rows of some keys
+
+        :param index: The index of the filtered column
+        :param num_rows: Number of rows in the datastore
+        :param begin: Position of the first key
+        :param end: Position after the last key
+        :returns: A sorted list with the rows of the keys
+    """
+    ranks = read_ranks(index, num_rows)
+    return numpy.flatnonzero((ranks >= begin) & (ranks < end)).tolist()
+
+## ============================================================================
+def group_codes(plan, datastore, rows):
+    """ Codes the group of every selected row, combining the key position of
+        each group column, so the codes sort in the order of the group keys
+
+        :param plan: Dictionary with the requested query
+        :param datastore: Current datastore
+        :param rows: Array with the selected rows, None for all the rows
+        :returns: An integer array with the group code of every row and a
+                  function to get the key positions of a code
+    """
+    codes = None
+    sizes = []
+    for column in plan['group_by']:
+        index = datastore['indexes'][column.name]
+        ranks = read_ranks(index, datastore['num_rows'])
+        if rows is not None:
+            ranks = ranks[rows]
+        codes = ranks if codes is None else codes * len(index) + ranks
+        sizes.append(len(index))
+    def positions(code):
+        result = []
+        for size in reversed(sizes):
+            code, position = divmod(code, size)
+            result.insert(0, position)
+        return result
+    return codes, positions
+
+## ============================================================================
+def reduce_values(aggregate, values, groups, num_groups):
+    """ Computes an aggregate of the values of each group
+
+        :param aggregate: min, max, sum or count
+        :param values: Integer array with the values, None for count
+        :param groups: Array with the group number of every value
+        :param num_groups: Number of groups
+        :returns: An array with the aggregate of every group
+    """
+    if aggregate == 'count':
+        return numpy.bincount(groups, minlength=num_groups)
+    if aggregate == 'sum':
+        return numpy.bincount(groups, weights=values, minlength=num_groups).round()
+    if aggregate == 'min':
+        result = numpy.full(num_groups, numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+        numpy.minimum.at(result, groups, values)
+    else:
+        result = numpy.full(num_groups, numpy.iinfo(numpy.int64).min, dtype=numpy.int64)
+        numpy.maximum.at(result, groups, values)
+    return result
+
+## ============================================================================
+def execute_vectorized(plan, datastore, options):
+    """ Executes an aggregate plan with array reductions. The results are set
+        in the select columns of the plan (or of each group), which are only
+        used to format the output
+
+        :param plan: Dictionary with the requested query
+        :param datastore: Current datastore
+        :param options: Command line arguments
+    """
+    rows = None
+    if len(plan['rows']) < datastore['num_rows']:
+        rows = numpy.asarray(plan['rows'], dtype=numpy.int64)
+    num_selected = datastore['num_rows'] if rows is None else len(rows)
+    if plan['group_by']:
+        codes, positions = group_codes(plan, datastore, rows)
+        keys, groups = numpy.unique(codes, return_inverse=True)
+    else:
+        keys, groups = [0], numpy.zeros(num_selected, dtype=numpy.int64)
+    if num_selected == 0:
+        keys = []
+    loaded = {}
+    results = []
+    for column in plan['columns']:
+        if column.aggregate == '':
+            results.append(None)
+            continue
+        values = None
+        if column.aggregate != 'count':
+            if column.name not in loaded:
+                debug('vectorized read of column %s', options.verbose, column.name)
+                loaded[column.name] = read_values(datastore, column, rows)
+            values = loaded[column.name]
+        results.append(reduce_values(column.aggregate, values, groups, len(keys)))
+    if not plan['group_by']:
+        for column, result in zip(plan['columns'], results):
+            if len(keys):
+                column.set_result(int(result[0]))
+        return
+    plan['groups'] = []
+    for group, code in enumerate(keys):
+        key_positions = positions(int(code))
+        states = [SelectColumn(c.column, c.aggregate) for c in plan['columns']]
+        for state, result in zip(states, results):
+            if result is not None:
+                state.set_result(int(result[group]))
+                continue
+            position = key_positions[plan['group_by'].index(state.column)]
+            index = datastore['indexes'][state.name]
+            state.add_parsed(state.type.decode(index.keys[position]))
+        plan['groups'].append(states)